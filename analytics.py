@@ -0,0 +1,88 @@
+# Temporal analytics on the downloaded daily series
+#
+# Moving averages, rolling maxima and percentiles and anomalies are computed
+# here from the daily series in the series store, instead of running a
+# moving-average UDF on the backend and downloading its result. Because the
+# spatial mean is linear, the moving average of the mean series equals the
+# mean of the per-pixel moving averages the UDF used to compute.
+#
+# Missing days count as NaN: a window is reduced over the values it holds, and
+# stays empty when it holds fewer than min_periods of them.
+import warnings
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# One row per day between the first and the last date, missing days as NaN,
+# so that a window always spans the same number of days
+def daily(series):
+    if series.empty:
+        return series.astype("float64")
+    index = pd.date_range(series.index.min(), series.index.max(), freq="D")
+    return series.astype("float64").reindex(index)
+
+
+# Days before and after the current one in a window; centered windows are
+# placed like np.convolve(..., mode="same") in the former UDF
+def _extent(window, center):
+    window = max(int(window), 1)
+    if center:
+        return window // 2, (window - 1) // 2
+    return window - 1, 0
+
+
+def moving_average(series, window=31, center=True, min_periods=1):
+    series = daily(series)
+    values = series.to_numpy()
+    valid = ~np.isnan(values)
+
+    # Sums and counts of the valid values over every window, from cumulative sums
+    sums = np.concatenate([[0.0], np.cumsum(np.where(valid, values, 0.0))])
+    counts = np.concatenate([[0], np.cumsum(valid)])
+    before, after = _extent(window, center)
+    days = np.arange(len(values))
+    lo = np.clip(days - before, 0, len(values))
+    hi = np.clip(days + after + 1, 0, len(values))
+    count = counts[hi] - counts[lo]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (sums[hi] - sums[lo]) / count
+    mean[count < max(min_periods, 1)] = np.nan
+    return pd.Series(mean, index=series.index, name=series.name)
+
+
+# Reduce every window with reduce(windows) -> one value per row
+def _rolling(series, window, center, min_periods, reduce):
+    series = daily(series)
+    values = series.to_numpy()
+    if not len(values):
+        return series
+    before, after = _extent(window, center)
+    windows = sliding_window_view(np.pad(values, (before, after), constant_values=np.nan), before + after + 1)
+    enough = (~np.isnan(windows)).sum(axis=1) >= max(min_periods, 1)
+    out = np.full(len(values), np.nan)
+    if enough.any():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            out[enough] = reduce(windows[enough])
+    return pd.Series(out, index=series.index, name=series.name)
+
+
+def rolling_max(series, window=31, center=True, min_periods=1):
+    return _rolling(series, window, center, min_periods, lambda windows: np.nanmax(windows, axis=1))
+
+
+# q between 0 and 100, e.g. 90 for the 90th percentile
+def rolling_percentile(series, q, window=31, center=True, min_periods=1):
+    return _rolling(series, window, center, min_periods, lambda windows: np.nanpercentile(windows, q, axis=1))
+
+
+# Departure of every day from a baseline: a number, a series aligned on the
+# dates (e.g. a moving average), or by default the mean of the whole series
+def anomaly(series, baseline=None):
+    series = daily(series)
+    if baseline is None:
+        baseline = series.mean()
+    elif isinstance(baseline, pd.Series):
+        baseline = daily(baseline).reindex(series.index)
+    return series - baseline
@@ -1,22 +1,107 @@
 # Load required packages
+# (the heavy ones - openeo, rasterio, imageio, pandas, matplotlib, ipyleaflet - are imported where they are used)
 from pathlib import Path
 from shiny import App, render, ui, reactive
-from shinywidgets import output_widget, render_widget
-import openeo, json, asyncio, sys, rasterio, imageio, os, re, datetime
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import ipyleaflet as L
+from shinywidgets import output_widget, register_widget
+import os, time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-from shiny.types import ImgData
-
-# openeo connection and authentication 
-# https://open-eo.github.io/openeo-python-client/auth.html
-## In Linux terminal :
-## openeo-auth oidc-auth openeo.cloud
-con = openeo.connect("openeo.cloud")
-con.authenticate_oidc()
+from starlette.applications import Starlette
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse
+from starlette.routing import Mount, Route
+import backends, pipeline, tiling
+from cache import ResultCache
+from jobs import JobCancelled, JobManager
+from lazy import Lazy
+from metrics import Metrics
+from prefetch import Prefetcher, read_regions
+from workspace import WorkspaceManager
+
+# openeo connection and authentication, shared by every session (S5P_BACKEND=fake serves local fixtures instead)
+# It is established in the background, so the worker starts serving before the backend answers
+con = backends.SharedConnection()
+
+# Local cache of downloaded results, shared by every session
+results = ResultCache("cache/results", max_bytes = 2 * 1024**3)
+
+# Daily mean/max series already fetched, per bbox, cloud threshold and reducer
+def series_store_():
+  from series import SeriesStore
+  return SeriesStore("cache/series")
+
+series_store = Lazy(series_store_)
+
+# Cubes already downloaded as daily maps, answering the queries of every tab they cover
+def cubes_():
+  from cubes import CubeStore
+  return CubeStore("cache/cubes.json")
+
+cubes = Lazy(cubes_)
+
+# Local station measurements, converted once and kept in memory for every session
+def stations_():
+  from stations import StationData
+  return StationData("data/rshiny_NO2_TM75_2017-2022.xlsx")
+
+stations = Lazy(stations_)
+
+# Cloud fraction threshold of a tab's input, 0.5 while it is empty
+def threshold(value):
+  return 0.5 if value is None else value
+
+# Threads for blocking backend downloads, so async handlers don't wait on them one by one
+downloader = ThreadPoolExecutor(max_workers = 8)
+
+# Threads building the Map Maker stacks and the animations; they wait on batch jobs for as long as
+# those take, so they don't hold the download threads the time-series chunks need
+builders = ThreadPoolExecutor(max_workers = 8)
+
+# Identical downloads and batch jobs of every session share one run; batch jobs have a bounded queue of their own
+jobs = JobManager(downloader, batch_workers = tiling.BATCH_JOBS, max_queued = 8, per_session = 2)
+
+# Popular regions (prefetch.json, or S5P_PREFETCH_REGIONS) fetched at startup and every
+# S5P_PREFETCH_INTERVAL seconds, so their first views are answered from the local stores;
+# only one worker process of the node prefetches, the one holding the lock file
+prefetch_regions = os.environ.get("S5P_PREFETCH_REGIONS", "prefetch.json")
+prefetcher = Prefetcher(con, results, series_store, cubes, jobs,
+                        read_regions(prefetch_regions) if os.path.exists(prefetch_regions) else [],
+                        interval = float(os.environ.get("S5P_PREFETCH_INTERVAL", 6 * 3600)), local = pipeline.LOCAL_MASKING)
+prefetcher.start(lock = "cache/prefetch.lock")
+
+# Temporary folders for each session's downloads, frames and animations
+workspaces = WorkspaceManager()
+
+# Timed stages of every tab and session, served on /metrics
+metrics = Metrics()
+for name in ("hits", "misses", "evictions", "bytes", "entries"):
+  metrics.gauge("s5p_result_cache_" + name, lambda name = name: results.stats()[name])
+for name in ("in_flight", "batch_in_flight", "started", "coalesced", "cancelled"):
+  metrics.gauge("s5p_jobs_" + name, lambda name = name: jobs.stats()[name])
+for name in ("cubes", "hits"):
+  metrics.gauge("s5p_cube_store_" + name, lambda name = name: cubes.stats()[name])
+metrics.gauge("s5p_open_sessions", lambda: len(workspaces))
+metrics.gauge("s5p_prefetch_oldest_age_seconds", prefetcher.oldest_age)
+metrics.gauge("s5p_prefetch_stale_regions", prefetcher.stale)
+
+# Value of fn() once it has stopped changing for delay seconds, e.g. while a number is being typed
+def debounce(delay, fn):
+  latest = reactive.Value(None)
+  settled = reactive.Value(None)
+  
+  @reactive.Effect
+  def track():
+    latest.set((fn(), time.monotonic()))
+  
+  @reactive.Effect
+  def settle():
+    value, changed = latest()
+    wait = changed + delay - time.monotonic()
+    if wait > 0:
+      reactive.invalidate_later(wait)
+    else:
+      settled.set(value)
+  
+  return settled
 
 # Define User Interface
 app_ui = ui.page_fluid(
@@ -67,7 +152,15 @@ app_ui = ui.page_fluid(
             # Submit Button
             ui.input_action_button("data1", "Submit"),
             
-            ui.output_text("compute")
+            ui.output_text("compute"),
+            
+            # Computed from the downloaded series, so changing them redraws the plot at once
+            ui.input_numeric("window", "Moving average window (days)", 31, min = 1, max = 365, step = 1),
+            ui.input_checkbox_group("stats", "Also show", {
+              "max": "Rolling max",
+              "p90": "Rolling 90th percentile",
+              "anomaly": "Anomaly (Mean - MA)"
+              })
             
           ),
           # Time Series Plot
@@ -98,15 +191,17 @@ app_ui = ui.page_fluid(
             # Map with bbox
             output_widget("map_mm"),
             
-            # Date for Plot
-            ui.input_date("date", "Select Date of the Slice", startview='year', value="2019-07-12",
-            min = "2019-01-01", max = str(date.today())),
+            # Date for Plot, any day of the timeframe is rendered from the downloaded stack
+            ui.input_slider("date", "Select Date of the Slice", min = date(2019, 5, 1), max = date(2019, 8, 31),
+            value = date(2019, 7, 12), time_format = "%Y-%m-%d"),
                          
             # Cloud Cover 
             ui.input_numeric("cloud2", "cloud cover to be considered? (0 to 1 - 0.5 is recommended)", 0.5, min = 0, max = 1, step = .1),
 
             # Submit Button
-            ui.input_action_button("data2", "Submit")
+            ui.input_action_button("data2", "Submit"),
+            
+            ui.output_text("compute2")
             
           ),
           # Time Series Plot
@@ -141,13 +236,18 @@ app_ui = ui.page_fluid(
 
             # Cloud Cover 
             ui.input_numeric("fps", "Frames per Second", 2, min = 1, max = 80, step = 10),
+            
+            # Output Format (MP4 and WebM need imageio-ffmpeg, otherwise a GIF is made)
+            ui.input_select("video_format", "Format", {"mp4": "MP4 video", "webm": "WebM video", "gif": "GIF"}),
             # Submit Button
-            ui.input_action_button("data3", "Submit")
+            ui.input_action_button("data3", "Submit"),
+            
+            ui.output_text("compute3")
             
           ),
           # Time Series Plot
           ui.panel_main(
-            ui.output_image("image")
+            ui.output_ui("image")
           ),
         ),
       )
@@ -157,271 +257,258 @@ app_ui = ui.page_fluid(
 
 def server(input, output, session):
     
-    # Leaft Map for Time Series
-    @output
-    @render_widget
-    def map_ts():
-      center_y = (input.s() + input.n())/2
-      center_x = (input.w() + input.e())/2
-      m = L.Map(center=(center_y, center_x), zoom=6)
-      rectangle = L.Rectangle(bounds=((input.n(), input.w()), (input.s(), input.e())))
-      m.add_layer(rectangle)
-      return m
+    # Scratch space of this session, removed when the session ends
+    ws = workspaces.open(session)
     
-    # Leaft Map for Map Maker
-    @output
-    @render_widget
-    def map_mm():
-      center_y = (input.s2() + input.n2())/2
-      center_x = (input.w2() + input.e2())/2
-      m = L.Map(center=(center_y, center_x), zoom=6)
-      rectangle = L.Rectangle(bounds=((input.n2(), input.w2()), (input.s2(), input.e2())))
+    # Jobs nobody else waits for are dropped when the session ends
+    session.on_ended(lambda: jobs.release(session.id))
+    
+    # Timed stage of a tab in this session
+    def span(tab, stage, **tags):
+      return metrics.span(stage, tab, session.id, **tags)
+    
+    # Leaflet map of a tab's bbox, sent to the browser once: its rectangle and centre follow the
+    # bbox inputs in place, and a rectangle drawn on the map is written back into the inputs
+    def bbox_map(id, suffix):
+      import ipyleaflet as L
+      sides = [input["w" + suffix], input["s" + suffix], input["e" + suffix], input["n" + suffix]]
+      
+      def bounds(bbox):
+        w, s, e, n = bbox
+        return ((s, w), (n, e)), ((s + n)/2, (w + e)/2)
+      
+      with reactive.isolate():
+        rectangle_bounds, center = bounds([side() for side in sides])
+      m = L.Map(center=center, zoom=6)
+      rectangle = L.Rectangle(bounds=rectangle_bounds)
       m.add_layer(rectangle)
-      return m
+      
+      draw = L.DrawControl(rectangle = {"shapeOptions": {"color": "#3388ff"}}, polygon = {}, polyline = {},
+                           circlemarker = {}, edit = False, remove = False)
+      def drawn(target, action, geo_json):
+        if action != "created":
+          return
+        xs, ys = zip(*geo_json["geometry"]["coordinates"][0])
+        for side, value in zip("wsen", (min(xs), min(ys), max(xs), max(ys))):
+          ui.update_numeric(side + suffix, value = round(value, 2), session = session)
+        # The rectangle of the inputs shows it from now on
+        draw.clear()
+      draw.on_draw(drawn)
+      m.add_control(draw)
+      register_widget(id, m)
+      
+      # Only a bbox that stopped changing for a moment is sent, not every keystroke
+      bbox = debounce(0.5, lambda: tuple(side() for side in sides))
+      
+      @reactive.Effect
+      def follow():
+        if bbox() is None or None in bbox():
+          return
+        rectangle.bounds, m.center = bounds(bbox())
+    
+    bbox_map("map_ts", "")
+    bbox_map("map_mm", "2")
+    bbox_map("map_sa", "3")
+    
+    # Time-series request in flight; its chunks are merged into the series store as they land
+    ts_request = {"count": 0, "current": None}
+    
+    def ts_landed():
+      current = ts_request["current"]
+      return None if current is None else (ts_request["count"], current["fetch"].completed)
+    
+    # Redraws the plot whenever another chunk has landed
+    @reactive.poll(ts_landed, 0.5)
+    def ts_current():
+      return ts_request["current"]
+    
+    @reactive.Effect
+    @reactive.event(input.data1)
+    def fetch_ts():
+      from series import SeriesFetch
+      
+      # Define the Spatial Extent
+      bbox = (input.w(), input.s(), input.e(), input.n())
+      start, end = input.date1date2()
+      cloud = threshold(input.cloud1())
+      
+      # Mean and Max only need the days that are not in the series store yet. They are fetched side
+      # by side on the download threads, and the plot follows them as they land; a fetch another
+      # session is already running is waited for instead of run again
+      ts_request["count"] += 1
+      tag = "time-series-" + str(ts_request["count"])
+      keys, futures = pipeline.fetch_series(con, results, jobs, series_store, bbox, start, end, cloud, session.id, tag,
+                                            stage = lambda name: span("time-series", name), cubes = cubes,
+                                            local = pipeline.LOCAL_MASKING)
+      
+      # A new Submit drops the chunks of the previous one that are not needed any more
+      jobs.release(session.id, "time-series-" + str(ts_request["count"] - 1))
+      ts_request["current"] = {
+        "fetch": SeriesFetch(futures),
+        "bbox": bbox, "start": start, "end": end, "keys": keys
+        }
     
-    # Leaflet Map for Spacetime Animation
     @output
-    @render_widget
-    def map_sa():
-      center_y = (input.s3() + input.n3())/2
-      center_x = (input.w3() + input.e3())/2
-      m = L.Map(center=(center_y, center_x), zoom=6)
-      rectangle = L.Rectangle(bounds=((input.n3(), input.w3()), (input.s3(), input.e3())))
-      m.add_layer(rectangle)
-      return m
+    @render.text
+    def compute():
+      current = ts_current()
+      if current is None:
+        return ""
+      fetch = current["fetch"]
+      if fetch.done():
+        return "Done" if not fetch.errors else "Failed: " + str(fetch.errors[0])
+      return "Downloading... " + str(fetch.completed) + " of " + str(fetch.total) + " downloads done"
     
     @output
     @render.plot
-    @reactive.event(input.data1) 
     async def plot_ts():
+      import pandas as pd
+      import matplotlib.pyplot as plt
+      import analytics
       
-      with ui.Progress(min=1, max=6) as p:
+      current = ts_current()
+      if current is None:
+        return None
+      fetch = current["fetch"]
+      if fetch.done() and fetch.errors:
+        raise fetch.errors[0]
+      bbox, start, end, keys = current["bbox"], current["start"], current["end"], current["keys"]
+      window = int(input.window() or 31)
       
-        # Define the Spatial Extent
-        extent = { # Münster
-          "type": "Polygon",
-          "coordinates": [[
-            [input.w(), input.n()],
-            [input.e(), input.n()],
-            [input.e(), input.s()],
-            [input.w(), input.s()],
-            [input.w(), input.n()]
-            ]]
-            }
+      # Stored series, aligned on the date index
+      with span("time-series", "parse"):
+        ts_df = pd.DataFrame({
+          "Mean": series_store.get(keys["mean"], start, end),
+          "Max": series_store.get(keys["max"], start, end)
+          })
+        ts_df.index.name = "Date"
       
-        p.set(1, message="Local Wrangling")
-            
-        # Build the Datacube    
-        # datacube = con.load_collection(
-        #   "TERRASCOPE_S5P_L3_NO2_TD_V1",
-        #   spatial_extent = extent,
-        #   temporal_extent = [input.date1date2()[0], input.date1date2()[1]]
-        #   )
-        # 
-        datacube = con.load_collection(
-          "SENTINEL_5P_L2",
-          spatial_extent = extent,
-          temporal_extent = [input.date1date2()[0], input.date1date2()[1]],
-          bands=["NO2"]
-          )
-
-        datacube_cloud = con.load_collection(
-          "SENTINEL_5P_L2",
-          spatial_extent = extent,
-          temporal_extent = [input.date1date2()[0], input.date1date2()[1]],
-          bands=["CLOUD_FRACTION"]
-          )
-
-        # mask for cloud cover
-        def threshold_(data):
-
-          threshold = data[0].gte(0.5)
-
-          return threshold
-
-        # apply the threshold to the cube
-        cloud_threshold = datacube_cloud.apply(process = threshold_)
-
-        #   # mask the cloud cover with the calculated mask
-        datacube = datacube.mask(cloud_threshold)
-
-        # Fill Gaps
-        datacube = datacube.apply_dimension(dimension = "t", process = "array_interpolate_linear")
-        
-        # Moving Average Window
-        moving_average_window = 31
-        
-        with open('ma.py', 'r') as file:
-          udf_file = file.read()
-          
-        udf = openeo.UDF(udf_file.format(n = moving_average_window))
-        datacube_ma = datacube.apply_dimension(dimension = "t", process = udf)
-        
-        # Timeseries as JSON
-        p.set(2, message="Downloading Mean Values... may take a while")
-        
-        ## Mean as Aggregator
-        datacube_mean = datacube.aggregate_spatial(geometries = extent, reducer = "mean")
-        datacube_mean = datacube_mean.download("data/time-series-mean.json")
-        
-        p.set(3, message="Downloading Max Values... may take a while")
-        
-        ## Max as Aggregator
-        datacube_max = datacube.aggregate_spatial(geometries = extent, reducer = "max")
-        datacube_max = datacube_max.download("data/time-series-max.json")
-        
-        p.set(4, message="Downloading Moving Average... may take a while")
-        
-        ## Mean as Aggregator for Moving Average Data Cube
-        datacube_ma = datacube_ma.aggregate_spatial(geometries = extent, reducer = "mean")
-        datacube_ma = datacube_ma.download("data/time-series-ma.json")
-        
-        p.set(5, message="Reading JSONs")
-        
-        # Read in JSONs
-        with open("data/time-series-mean.json", "r") as f:
-          ts_mean = json.load(f)
-        print("mean time series read")
-        
-        with open("data/time-series-max.json", "r") as f:
-          ts_max = json.load(f)
-        print("max time series read")
-  
-        with open("data/time-series-ma.json", "r") as f:
-          ts_ma = json.load(f)
-        print("ma time series read")
-    
-        ts_df = pd.DataFrame.from_dict(ts_mean, orient='index', columns=['Mean']).reset_index()
-        ts_df.columns = ['Date', 'Mean']
-        ts_df['Mean'] = ts_df['Mean'].str.get(0)
-       
-        ts_max_df = pd.DataFrame.from_dict(ts_max, orient='index', columns=['Max']).reset_index()
-        ts_max_df.columns = ['Date', 'Max']
-        ts_df['Max'] = ts_max_df['Max'].str.get(0) 
-        
-        ts_ma_df = pd.DataFrame.from_dict(ts_ma, orient='index', columns=['MA']).reset_index()
-        ts_ma_df.columns = ['Date', 'MA']
-        ts_df['MA'] = ts_ma_df['MA'].str.get(0)
-        
-        # convert 'Date' column to datetime dtype
-        ts_df['Date'] = pd.to_datetime(ts_df['Date'])
-        
-        # set 'Date' column as index
-        ts_df.set_index('Date', inplace=True)
-        
-        # Time Series Smoothing
-        ts_df['Smooth'] = ts_df['Mean'].rolling(31).mean()
-        
-        # Add local data
-        if input.e() <= 12.55 and input.w() >= 10.35 and input.s() >= 46.10 and input.n() <= 47.13 and input.date1date2()[0] >= pd.Timestamp("2018-12-14") and input.date1date2()[1] <= pd.Timestamp("2021-12-31"):
-          
-          df = pd.read_excel("data/rshiny_NO2_TM75_2017-2022.xlsx")
-          df = df.iloc[4:].iloc[:, 1:]
-          
-          mean_no2 = df.mean(axis=1)
-          df["Date"] = pd.date_range(start="2017-01-01", periods=len(df), freq="D").date
-          df['Local'] = mean_no2  * 10e-2
-          df_local = df[['Date', 'Local']]
-          
-          # filter by date
-          # df_local = df_local[(df_local["Date"] > pd.Timestamp("2019-01-01")) & (df_local["Date"] < pd.Timestamp("2019-12-31"))]
-          df_local = df_local[(df_local["Date"] >= input.date1date2()[0]) & (df_local["Date"] <= input.date1date2()[1])]
-          
-          # left join by date
-          df_local['Date'] = pd.to_datetime(df_local['Date']).dt.tz_localize('UTC')
-          ts_df['Local'] = df_local['Local']
+      # Moving Average and the other statistics over the daily mean, computed locally
+      with span("time-series", "analytics", window = window):
+        ts_df["MA"] = analytics.moving_average(ts_df["Mean"], window)
+        if "max" in input.stats():
+          ts_df["Rolling Max"] = analytics.rolling_max(ts_df["Mean"], window)
+        if "p90" in input.stats():
+          ts_df["Rolling P90"] = analytics.rolling_percentile(ts_df["Mean"], 90, window)
+        if "anomaly" in input.stats():
+          ts_df["Anomaly"] = analytics.anomaly(ts_df["Mean"], ts_df["MA"])
       
-        # plot time series for each column
+      # Add local data, aligned with the satellite series on the date index
+      with span("time-series", "stations"):
+        if stations.covers(bbox, start, end):
+          ts_df['Local'] = stations.series(start, end)
+    
+      # plot time series for each column
+      with span("time-series", "render", partial = not fetch.done()):
         fig, ax = plt.subplots(figsize=(16, 12))
-        ts_df.plot(ax=ax)
+        if ts_df.notna().any().any():
+          ts_df.plot(ax=ax)
+        ax.set_xlim(pd.Timestamp(start, tz = "UTC"), pd.Timestamp(end, tz = "UTC"))
         ax.set_xlabel('Time')
         ax.set_ylabel('Value')
-        ax.set_title('NO2 Time Series from SENTINEL 5P')
+        title = 'NO2 Time Series from SENTINEL 5P'
+        if not fetch.done():
+          title += ' (' + str(fetch.completed) + ' of ' + str(fetch.total) + ' downloads done)'
+        ax.set_title(title)
         # plt.show()
-        
-        p.set(6, message="Done")
       
       return fig
     
+    # Batch job submit of request number count of a tab. The job of the request before is released
+    # only once this one is submitted, so a Submit of the same view joins the job that is still running
+    def batch_submit(request, name, count):
+      def submit(key, fn):
+        # A request that was submitted again meanwhile leaves the job to the new one
+        if request["count"] != count:
+          raise JobCancelled()
+        future = jobs.submit(key, fn, session.id, name + "-" + str(count), batch = True)
+        jobs.release(session.id, name + "-" + str(count - 1))
+        return future
+      return submit
+    
+    # Map Maker stack in flight; slices are rendered from it without going back to the backend
+    mm_request = {"count": 0, "future": None}
+    
+    def mm_landed():
+      future = mm_request["future"]
+      return None if future is None else (mm_request["count"], future.done())
+    
+    @reactive.poll(mm_landed, 0.5)
+    def mm_current():
+      return mm_request["future"]
+    
+    # The slider only offers days of the timeframe to interpolate over
+    @reactive.Effect
+    def slice_range():
+      start, end = input.date1date22()
+      ui.update_slider("date", min = start, max = end)
+    
+    @reactive.Effect
+    @reactive.event(input.data2)
+    def fetch_map():
+      # Define the Spatial Extent
+      bbox = (input.w2(), input.s2(), input.e2(), input.n2())
+      
+      # Every Submit has a tag of its own; the batch job of the previous one is dropped once the new
+      # one is submitted, unless another session waits for it too
+      previous, count = mm_request["future"], mm_request["count"]
+      mm_request["count"] += 1
+      mm_request["future"] = builders.submit(load_map_stack, bbox, input.date1date22(), threshold(input.cloud2()),
+                                             mm_request["count"])
+      
+      # Every request builds its stack in a folder of its own; the previous one is removed once its build is over
+      if previous is not None:
+        previous.add_done_callback(lambda future: ws.remove("map-maker", str(count)))
+    
+    # Daily slices of the whole timeframe (the end date included) as a local stack, from a stored cube
+    # or a batch job shared with other sessions; raw bands with local masking, masked as they are shown
+    def load_map_stack(bbox, dates, cloud, count):
+      from raster import DISPLAY_SIZE
+      
+      try:
+        return pipeline.load_maps(con, results, bbox, dates[0], dates[1], ws.folder("map-maker", str(count)),
+                                  batch_submit(mm_request, "map-maker", count), cloud,
+                                  stage = lambda name: span("map-maker", name), cubes = cubes,
+                                  local = pipeline.LOCAL_MASKING, max_size = DISPLAY_SIZE)
+      finally:
+        jobs.release(session.id, "map-maker-" + str(count - 1))
+    
+    @output
+    @render.text
+    def compute2():
+      future = mm_current()
+      if future is None:
+        return ""
+      if not future.done():
+        return "Downloading..."
+      return "Done" if future.exception() is None else "Failed: " + str(future.exception())
+    
     @output
     @render.plot
-    @reactive.event(input.data2)
-    async def plot_map():
+    def plot_map():
+      import matplotlib.pyplot as plt
+      from clouds import RawBands
       
-      with ui.Progress(min=1, max=4) as p:
+      future = mm_current()
+      if future is None or not future.done():
+        return None
+      stack = future.result()
       
-        # Define the Spatial Extent
-        extent = {
-          "type": "Polygon",
-          "coordinates": [[
-            [input.w2(), input.n2()],
-            [input.e2(), input.n2()],
-            [input.e2(), input.s2()],
-            [input.w2(), input.s2()],
-            [input.w2(), input.n2()]
-            ]]
-            }
-           
-        p.set(1, message="Data Cube Wrangling")
- 
-        # Build the Datacube    
-        # datacube = con.load_collection(
-        #   "TERRASCOPE_S5P_L3_NO2_TD_V1",
-        #   spatial_extent = extent,
-        #   temporal_extent = [input.date1date22()[0], input.date1date22()[1]]
-        #   )
-        
-        datacube = con.load_collection(
-          "SENTINEL_5P_L2",
-          spatial_extent = extent,
-          temporal_extent = [input.date1date2()[0], input.date1date2()[1]],
-          bands=["NO2"]
-          )
-
-        datacube_cloud = con.load_collection(
-          "SENTINEL_5P_L2",
-          spatial_extent = extent,
-          temporal_extent = [input.date1date2()[0], input.date1date2()[1]],
-          bands=["CLOUD_FRACTION"]
-          )
-
-        # mask for cloud cover
-        def threshold_(data):
-
-          threshold = data[0].gte(0.5)
-
-          return threshold
-
-        # apply the threshold to the cube
-        cloud_threshold = datacube_cloud.apply(process = threshold_)
-
-        #   # mask the cloud cover with the calculated mask
-        datacube = datacube.mask(cloud_threshold)
-        
-        # Fill Gaps
-        datacube = datacube.apply_dimension(dimension = "t", process = "array_interpolate_linear")
-        
-        # Filter Temporal
-        datacube = datacube.filter_temporal(extent = [input.date(), input.date()])
-        
-        # Safer for interpolation and plot dates
-        if input.date() > input.date1date22()[1] or input.date() < input.date1date22()[0]:
-          sys.exit("Date of Plot should be between the interpolation dates")
-
-        p.set(2, message="Downloading Results...")
-
-        # Download TIF
-        print("Processing and Downloading Results...")
-        datacube.download("data/map.tif")
-        
-        p.set(3, message="Reading Image into Memory")
-        
-        # Open TIF file
-        with rasterio.open("data/map.tif") as src:
-            image = src.read(1, masked=True)
-            vmin, vmax = image.min(), image.max() # Define minimum and maximum values for the color map
-        print("raster read")
-        
+      # Safer for interpolation and plot dates
+      day = input.date()
+      if day not in stack.dates:
+        raise ValueError("Date of Plot should be between the interpolation dates")
+      
+      # The slice is a view on the stack in memory; raw bands are masked and interpolated for
+      # that day at the current threshold, so changing it redraws the map without a new job
+      with span("map-maker", "read"):
+        if isinstance(stack, RawBands):
+          image = stack.frame(stack.index(day), threshold(input.cloud2()))
+        else:
+          image = stack.frame(stack.index(day))
+        vmin, vmax = image.min(), image.max() # Define minimum and maximum values for the color map
+      
+      with span("map-maker", "render"):
         # Create figure and axis objects
         fig, ax = plt.subplots()
         
@@ -430,165 +517,122 @@ def server(input, output, session):
         
         # Add colorbar and title
         cbar = fig.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
-        ax.set_title('NO2 Concentration Screenshot at '+input.date().strftime('%Y-%m-%d'))
-        
-        p.set(4, message="Done")
-        
-        # Show plot
-        # plt.show()
+        ax.set_title('NO2 Concentration Screenshot at '+day.strftime('%Y-%m-%d'))
+      
+      # Show plot
+      # plt.show()
       return fig
       
+    # Animation request in flight; it is built off the event loop, so other sessions keep being served
+    sa_request = {"count": 0, "future": None}
+    
+    def sa_landed():
+      future = sa_request["future"]
+      return None if future is None else (sa_request["count"], future.done())
+    
+    @reactive.poll(sa_landed, 0.5)
+    def sa_current():
+      return sa_request["future"]
+    
+    @reactive.Effect
+    @reactive.event(input.data3)
+    def start_gif():
+      # Read the inputs here, the animation itself is built on the builder threads
+      bbox = (input.w3(), input.s3(), input.e3(), input.n3())
+      
+      # Every Submit has a tag and a folder of its own, as in the Map Maker
+      previous, count = sa_request["future"], sa_request["count"]
+      sa_request["count"] += 1
+      sa_request["future"] = builders.submit(generate_animation, bbox, input.date1date23(), threshold(input.cloud3()),
+                                             input.fps(), input.video_format(), sa_request["count"])
+      if previous is not None:
+        previous.add_done_callback(lambda future: ws.remove("animation", str(count)))
+    
     @output
-    @render.image
-    @reactive.event(input.data3) 
-    async def image():
+    @render.text
+    def compute3():
+      future = sa_current()
+      if future is None:
+        return ""
+      if not future.done():
+        return "Processing..."
+      return "Done" if future.exception() is None else "Failed: " + str(future.exception())
+    
+    @output
+    @render.ui
+    def image():
+      import video
       
-      with ui.Progress(min=1, max=3) as p:
-        
-        p.set(1, message="Starting Process")
-        
-        p.set(2, message="Downloading")
-
-        generate_gif()
-        
-        print("done with function")
-        p.set(3, message="Done")
-        from pathlib import Path
-        
-        dir = Path(__file__).resolve().parent
-        img: ImgData = {"src": str(dir / "PNG" / 'spacetime-animation.gif'), "width": "1000px"}# Define the Spatial Extent
+      future = sa_current()
+      if future is None or not future.done():
+        return None
+      if future.exception() is not None:
+        raise future.exception()
+      output_filename, fmt = future.result()
       
-      return img
+      # Served from the session's workspace instead of being inlined into the page
+      src = session.dynamic_route("animation", lambda request: FileResponse(output_filename, media_type = video.mime_type(fmt)))
+      if fmt == "gif":
+        return ui.img(src = src, width = "1000px")
+      return ui.tags.video(ui.tags.source(src = src, type = video.mime_type(fmt)),
+                           controls = "", autoplay = "", loop = "", muted = "", width = "1000px")
     
-    #Generate a GIF function
-    def generate_gif():
-      extent = {
-        "type": "Polygon",
-        "coordinates": [[
-          [input.w3(), input.n3()],
-          [input.e3(), input.n3()],
-          [input.e3(), input.s3()],
-          [input.w3(), input.s3()],
-          [input.w3(), input.n3()]
-          ]]}
-              
-      # Build the Datacube    
-      # datacube = con.load_collection(
-      #   "TERRASCOPE_S5P_L3_NO2_TD_V1",
-      #   spatial_extent = extent,
-      #   temporal_extent = [input.date1date23()[0], input.date1date23()[1]])
-          
-      datacube = con.load_collection(
-          "SENTINEL_5P_L2",
-          spatial_extent = extent,
-          temporal_extent = [input.date1date2()[0], input.date1date2()[1]],
-          bands=["NO2"]
-          )
-
-      datacube_cloud = con.load_collection(
-          "SENTINEL_5P_L2",
-          spatial_extent = extent,
-          temporal_extent = [input.date1date2()[0], input.date1date2()[1]],
-          bands=["CLOUD_FRACTION"]
-          )
-
-      # mask for cloud cover
-      def threshold_(data):
-
-        threshold = data[0].gte(0.5)
-
-        return threshold
-
-      # apply the threshold to the cube
-      cloud_threshold = datacube_cloud.apply(process = threshold_)
-
-      #   # mask the cloud cover with the calculated mask
-      datacube = datacube.mask(cloud_threshold)
+    #Generate an animation (MP4, WebM or GIF) function
+    def generate_animation(bbox, dates, cloud, fps, fmt, count):
+      import video
+      from frames import FrameRenderer, render_frames
+      from raster import DISPLAY_SIZE
       
-      # Fill Gaps
-      datacube = datacube.apply_dimension(dimension = "t", process = "array_interpolate_linear")
-      
-      # Create job to download all raster in the time range
-      job = datacube.create_job()
-      print("Starting the job")
-      job.start_and_wait()
-      job.get_results().download_files("animation")
+      # Daily slices as in the Map Maker, but without the end date of the timeframe, with the global limits
+      days = pipeline.days(dates[0], max(dates[1] - pipeline.DAY, dates[0]))
+      try:
+        stack = pipeline.load_maps(con, results, bbox, days[0], days[-1], ws.folder("animation", str(count), "stack"),
+                                   batch_submit(sa_request, "animation", count), cloud,
+                                   stage = lambda name: span("animation", name), cubes = cubes,
+                                   local = pipeline.LOCAL_MASKING, max_size = DISPLAY_SIZE)
+      finally:
+        jobs.release(session.id, "animation-" + str(count - 1))
+      if pipeline.LOCAL_MASKING:
+        with span("animation", "mask"):
+          stack = stack.masked(cloud, ws.folder("animation", str(count), "masked-stack"))
+      global_min, global_max = stack.limits()
+      output_folder = ws.folder("animation", str(count), "output")
     
-      # Read in all TIF files in folder
-      input_folder = "animation"
-      output_folder = "PNG"
-      print("Reading TIFs")
-      filenames = os.listdir("animation")
-      tif_regex = re.compile(r'openEO_(\d{4}-\d{2}-\d{2})Z\.tif')
-      tif_files = [filename for filename in filenames if tif_regex.match(filename)]
-      tif_files_sorted = sorted(tif_files, key=lambda x: datetime.datetime.strptime(tif_regex.match(x).group(1), '%Y-%m-%d'))
-          
-      # Initialize variables to hold minimum and maximum values
-      global_min = float('inf')
-      global_max = float('-inf')
-          
-      for filename in tif_files_sorted:
-      # Open TIF file
-        filepath = os.path.join(input_folder, filename)
-        with rasterio.open(filepath) as src:
-          image = src.read(1, masked=True)
-                
-        # Update minimum and maximum values
-        file_min = np.min(image)
-        file_max = np.max(image)
-        if file_min < global_min:
-          global_min = file_min
-        if file_max > global_max:
-          global_max = file_max
-          
-      for filename in tif_files_sorted:
-      # Open TIF file
-        filepath = os.path.join(input_folder, filename)
-        with rasterio.open(filepath) as src:
-          image = src.read(1, masked=True)
-        
-        # Extract date from file name
-        date_str = tif_regex.match(filename).group(1)
-        input_date = datetime.datetime.strptime(date_str, '%Y-%m-%d')
-        
-        # Create figure and axis objects
-        fig, ax = plt.subplots(figsize=(16, 12))
-        
-        # Plot image as a continuous variable with a color legend
-        im = ax.imshow(image, cmap='viridis', vmin=global_min, vmax=global_max)
-        
-        # Add colorbar and title
-        cbar = fig.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
-        ax.set_title('NO2 Concentration at ' + input_date.strftime('%Y-%m-%d'))
-        
-        # Save plot as PNG file
-        output_filename = os.path.join("PNG", date_str + '.png')
-        plt.savefig(output_filename)
-            
-        # delete every tif file
-        os.remove(filepath)
+      # Without ffmpeg only the GIF encoder is there
+      if fmt not in video.formats():
+        fmt = "gif"
     
-      # Create animated GIF from PNG files
-      images = []
-      print("Reading PNGs")
-      for filename in os.listdir("PNG"):
-        if filename.endswith('.png'):
-          filepath = os.path.join("PNG", filename)
-          images.append(imageio.imread(filepath))
-      output_filename = os.path.join("PNG", 'spacetime-animation.gif')
-      print("Rendering GIF")
-      imageio.mimsave(output_filename, images, fps=input.fps())
+      # Colormap frames across worker processes (the layout is drawn only once) and
+      # write each one to the file as it arrives, so only a few frames are in memory at a time
+      output_filename = os.path.join(output_folder, 'spacetime-animation.' + fmt)
+      print("Rendering " + fmt.upper())
+      with span("animation", "encode", frames = len(stack), format = fmt) as timed:
+        renderer = FrameRenderer(stack.shape[1:], global_min, global_max)
+        with video.open_writer(output_filename, fmt, fps, renderer.lut) as writer:
+          for frame in render_frames(renderer, stack):
+            writer.append_data(frame)
+        timed.bytes = os.path.getsize(output_filename)
+
+      print(fmt.upper() + " saved")
+      return output_filename, fmt
+    
+www_dir = Path(__file__).parent / "WWW"
+shiny_app = App(app_ui, server, static_assets=www_dir)
 
-      print("GIF saved")
-      # Render for Shiny UI
-        
-      # Remove images
-      for file in os.listdir("PNG"):
-        if file.endswith(".png"):
-         file_path = os.path.join("PNG", file)
-         os.remove(file_path)
-        
-      return None
+# Stage histograms for Prometheus, and the most recent spans as JSON
+async def metrics_text(request):
+  return PlainTextResponse(metrics.render(), media_type = "text/plain; version=0.0.4")
 
-www_dir = Path(__file__).parent / "WWW"
-app = App(app_ui, server, static_assets=www_dir)
+async def metrics_spans(request):
+  return JSONResponse(metrics.spans())
+
+# When every prefetched region was last fetched
+async def prefetch_status(request):
+  return JSONResponse(prefetcher.status())
+
+app = Starlette(routes = [
+  Route("/metrics", metrics_text),
+  Route("/metrics/spans", metrics_spans),
+  Route("/prefetch", prefetch_status),
+  Mount("/", app = shiny_app)
+  ])
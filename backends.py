@@ -0,0 +1,274 @@
+# Backends the dashboard can talk to
+#
+# connect() returns either a real openEO connection or a local stand-in that
+# answers the same DataCube calls used by the app (load_collection, apply,
+# mask, apply_dimension, filter_temporal, aggregate_spatial, download,
+# create_job and the batch job calls) from the recorded fixtures in data/ and
+# animation/, after a configurable latency. This allows running and
+# benchmarking the app offline.
+#
+# S5P_BACKEND=fake selects the stand-in, S5P_FAKE_LATENCY sets its delay in seconds.
+#
+# SharedConnection wraps connect() for the app: one connection for every
+# session, established in the background so a worker starts serving at once,
+# and re-authenticated before the access token runs out.
+import datetime, json, os, shutil, threading, time
+import numpy as np
+
+FIXTURES = os.path.dirname(os.path.abspath(__file__))
+
+# Degrees per pixel of the map fixture, in x and y
+PIXEL = (0.05456349206348297, 0.03472222222221604)
+
+
+def connect(backend=None, latency=None):
+    backend = backend or os.environ.get("S5P_BACKEND", "openeo.cloud")
+    if backend == "fake":
+        if latency is None:
+            latency = float(os.environ.get("S5P_FAKE_LATENCY", "0"))
+        return FakeConnection(latency=latency)
+
+    # https://open-eo.github.io/openeo-python-client/auth.html
+    ## In Linux terminal :
+    ## openeo-auth oidc-auth openeo.cloud
+    import openeo
+    con = openeo.connect(backend)
+    con.authenticate_oidc()
+    return con
+
+
+class SharedConnection:
+
+    def __init__(self, backend=None, refresh_after=45 * 60):
+        self.backend = backend
+        self.refresh_after = refresh_after
+        self._con = None
+        self._authenticated = 0.0
+        self._refreshing = False
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._connect, name="openeo-connect", daemon=True).start()
+
+    def _connect(self):
+        try:
+            self._con = connect(self.backend)
+            self._authenticated = time.time()
+        except Exception as e:
+            print("openEO connection failed, retrying on first use:", e)
+        finally:
+            self._ready.set()
+
+    def _refresh(self):
+        try:
+            self._con.authenticate_oidc()
+            self._authenticated = time.time()
+        except Exception as e:
+            print("openEO token refresh failed:", e)
+        finally:
+            self._refreshing = False
+
+    # The connection, waiting for the background connect if it is still running
+    def _resolve(self):
+        self._ready.wait()
+        with self._lock:
+            if self._con is None:
+                self._con = connect(self.backend)
+                self._authenticated = time.time()
+            elif (hasattr(self._con, "authenticate_oidc") and not self._refreshing
+                  and time.time() - self._authenticated > self.refresh_after):
+                # Sessions keep using the current token while a new one is fetched
+                self._refreshing = True
+                threading.Thread(target=self._refresh, name="openeo-refresh", daemon=True).start()
+        return self._con
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+
+# Records what a process callback does with its data, e.g. data[0].gte(0.5)
+class _Expression:
+
+    def __init__(self, node):
+        self.node = node
+
+    def __getitem__(self, index):
+        return _Expression({"process_id": "array_element", "arguments": {"data": self.node, "index": index}})
+
+    def __getattr__(self, process_id):
+        if process_id.startswith("__"):
+            raise AttributeError(process_id)
+        return lambda *args: _Expression({"process_id": process_id, "arguments": {"x": self.node, "y": list(args)}})
+
+
+def _process(process):
+    if callable(process):
+        return process(_Expression({"from_parameter": "data"})).node
+    if hasattr(process, "code"):
+        return {"process_id": "run_udf", "arguments": {"udf": process.code}}
+    return process
+
+
+class FakeConnection:
+
+    def __init__(self, fixtures=FIXTURES, latency=0.0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.requests = 0
+
+    def load_collection(self, collection_id, spatial_extent=None, temporal_extent=None, bands=None):
+        node = {"process_id": "load_collection", "arguments": {
+            "id": collection_id, "spatial_extent": spatial_extent,
+            "temporal_extent": [str(d) for d in temporal_extent], "bands": bands}}
+        return FakeCube(self, [node])
+
+    # One backend round-trip
+    def wait(self):
+        self.requests += 1
+        time.sleep(self.latency)
+
+
+class FakeCube:
+
+    def __init__(self, connection, nodes):
+        self.connection = connection
+        self.nodes = nodes
+
+    def _then(self, process_id, **arguments):
+        return FakeCube(self.connection, self.nodes + [{"process_id": process_id, "arguments": arguments}])
+
+    def apply(self, process):
+        return self._then("apply", process=_process(process))
+
+    def mask(self, mask):
+        return self._then("mask", mask=mask.flat_graph())
+
+    def apply_dimension(self, dimension, process):
+        process = _process(process)
+        if isinstance(process, str):
+            process = {"process_id": process}
+        return self._then("apply_dimension", dimension=dimension, process=process)
+
+    def filter_temporal(self, extent):
+        return self._then("filter_temporal", extent=[str(d) for d in extent])
+
+    def aggregate_spatial(self, geometries, reducer):
+        return self._then("aggregate_spatial", geometries=geometries, reducer=reducer)
+
+    def flat_graph(self):
+        return {process["process_id"] + str(i): process for i, process in enumerate(self.nodes)}
+
+    def create_job(self):
+        return FakeJob(self)
+
+    def _find(self, process_id):
+        return [node["arguments"] for node in self.nodes if node["process_id"] == process_id]
+
+    # Days of the requested extent, with openEO's exclusive end date
+    def dates(self):
+        extent = (self._find("filter_temporal") or self._find("load_collection"))[-1]
+        extent = extent.get("extent", extent.get("temporal_extent"))
+        start, end = [datetime.date.fromisoformat(d[:10]) for d in extent]
+        days = max((end - start).days, 1)
+        return [start + datetime.timedelta(days=i) for i in range(days)]
+
+    # (w, s, e, n) of the requested spatial extent, or None without one
+    def bbox(self):
+        extent = self._find("load_collection")[-1]["spatial_extent"]
+        if not extent:
+            return None
+        if "coordinates" in extent:
+            xs, ys = zip(*extent["coordinates"][0])
+            return min(xs), min(ys), max(xs), max(ys)
+        return extent["west"], extent["south"], extent["east"], extent["north"]
+
+    # Fixture series replayed over the requested days; "count" is the number
+    # of fixture-sized pixels in the extent on the days the mean has a value
+    def series(self, name):
+        source = "mean" if name == "count" else name
+        with open(os.path.join(self.connection.fixtures, "data", "time-series-" + source + ".json")) as f:
+            values = list(json.load(f).values())
+        if name == "count":
+            w, s, e, n = self.bbox() or (0, 0, 1, 1)
+            pixels = round((e - w) * (n - s) / (PIXEL[0] * PIXEL[1]))
+            values = [[[0 if v[0][0] is None else pixels]] for v in values]
+        return {d.isoformat() + "T00:00:00Z": values[i % len(values)] for i, d in enumerate(self.dates())}
+
+    def download(self, outputfile, format=None, options=None):
+        self.connection.wait()
+        aggregate = self._find("aggregate_spatial")
+        if aggregate:
+            udf = [node for node in self._find("apply_dimension") if node["process"].get("process_id") == "run_udf"]
+            name = "ma" if udf else aggregate[-1]["reducer"]
+            if name not in ("mean", "max", "ma", "count"):
+                name = "mean"
+            with open(outputfile, "w") as f:
+                json.dump(self.series(name), f)
+        else:
+            shutil.copyfile(os.path.join(self.connection.fixtures, "data", "map.tif"), outputfile)
+        return outputfile
+
+
+class FakeJob:
+
+    def __init__(self, cube):
+        self.cube = cube
+        self.job_id = "fake-" + str(id(self))
+        self._finishes = None
+        self._stopped = False
+
+    def start_and_wait(self):
+        self.cube.connection.wait()
+        return self
+
+    # Polled variant: the job finishes once the latency has passed
+    def start_job(self):
+        self.cube.connection.requests += 1
+        self._finishes = time.time() + self.cube.connection.latency
+
+    def status(self):
+        if self._stopped:
+            return "canceled"
+        if self._finishes is None:
+            return "created"
+        return "finished" if time.time() >= self._finishes else "running"
+
+    def stop_job(self):
+        self._stopped = True
+
+    def get_results(self):
+        return self
+
+    # One TIF per day: the map fixture scaled by the day's value of the mean series,
+    # repeated over the requested extent at the fixture's resolution. A cube of the
+    # raw NO2 and CLOUD_FRACTION bands gets a second band of random cloud fractions in (0, 1]
+    def download_files(self, target=None, include_stac_metadata=True):
+        import rasterio
+        from rasterio.transform import from_bounds
+
+        fixtures = self.cube.connection.fixtures
+        os.makedirs(target, exist_ok=True)
+        with rasterio.open(os.path.join(fixtures, "data", "map.tif")) as src:
+            profile = src.profile
+            image = src.read(1)
+        bbox = self.cube.bbox()
+        if bbox is not None:
+            w, s, e, n = bbox
+            width, height = max(round((e - w) / PIXEL[0]), 1), max(round((n - s) / PIXEL[1]), 1)
+            image = image[np.arange(height) % image.shape[0]][:, np.arange(width) % image.shape[1]]
+            profile.update(width=width, height=height, transform=from_bounds(w, s, e, n, width, height))
+        mean = np.array([v[0][0] for v in self.cube.series("mean").values()], dtype="float64")
+        mean = mean / np.nanmean(mean)
+        raw = "CLOUD_FRACTION" in (self.cube._find("load_collection")[-1]["bands"] or [])
+        profile.update(count=2 if raw else 1)
+        files = []
+        for factor, day in zip(mean, self.cube.dates()):
+            filename = os.path.join(target, "openEO_" + day.isoformat() + "Z.tif")
+            with rasterio.open(filename, "w", **profile) as dst:
+                dst.write((image * factor).astype(profile["dtype"]), 1)
+                if raw:
+                    cloud = 1 - np.random.default_rng(day.toordinal()).random(image.shape)
+                    dst.write(cloud.astype(profile["dtype"]), 2)
+            files.append(filename)
+        if include_stac_metadata:
+            shutil.copyfile(os.path.join(fixtures, "animation", "job-results.json"), os.path.join(target, "job-results.json"))
+        return files
@@ -0,0 +1,139 @@
+# Headless batch runs of the dashboard pipeline
+#
+# Produces the time series and daily maps of many regions without the UI,
+# e.g. for nightly reports. Regions come from a CSV file with the columns
+# name, west, south, east, north, start and end (dates as YYYY-MM-DD), and
+# are processed side by side in worker processes sharing the result cache.
+#
+#   S5P_BACKEND=fake python batch.py regions.csv --out reports --workers 4
+#
+# Writes reports/time-series.parquet (one row per region and day: mean, max
+# and moving average) and reports/maps/<name>.tif (one band per day).
+# --local-masking masks and gap-fills the raw bands locally (see clouds.py),
+# so runs with another --cloud reuse their cached download.
+import argparse, csv, datetime, multiprocessing, os, sys, tempfile, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Connection and result cache of a worker process, opened by its first region
+_con = None
+_results = None
+
+
+def read_regions(path):
+    with open(path, newline="") as f:
+        regions = []
+        for row in csv.DictReader(f):
+            regions.append({
+                "name": row["name"],
+                "bbox": tuple(float(row[side]) for side in ("west", "south", "east", "north")),
+                "start": datetime.date.fromisoformat(row["start"]),
+                "end": datetime.date.fromisoformat(row["end"]),
+                })
+    return regions
+
+
+def _worker(cache):
+    global _con, _results
+    if _con is None:
+        import backends
+        from cache import ResultCache
+        _con = backends.connect()
+        _results = ResultCache(cache)
+    return _con, _results
+
+
+# Daily mean, max and moving average of a region, fetched month by month like the
+# dashboard does, so both share the cached chunks
+def region_series(con, results, region, cloud=0.5, window=31, local=False):
+    import pandas as pd
+    import analytics
+    import pipeline
+    from series import monthly_chunks
+
+    columns = {}
+    for reducer in ("mean", "max"):
+        chunks = [pipeline.aggregate(con, results, region["bbox"], a, b, reducer, cloud, local=local)
+                  for a, b in monthly_chunks(region["start"], region["end"])]
+        columns[reducer] = pd.concat(chunks).sort_index()
+    df = pd.DataFrame(columns)
+    df["ma"] = analytics.moving_average(df["mean"], window)
+    df.index.name = "date"
+    df = df.reset_index()
+    df.insert(0, "region", region["name"])
+    return df
+
+
+# Daily maps of a region as one GeoTIFF
+def region_maps(con, results, region, target, cloud=0.5, local=False):
+    import pipeline
+    from clouds import load_bands
+    from raster import load_stack, write_geotiff
+
+    temporal_extent = pipeline.temporal_extent(region["start"], region["end"])
+    with tempfile.TemporaryDirectory() as tmp:
+        if local:
+            bands = load_bands(pipeline.raw_maps(con, results, region["bbox"], temporal_extent), os.path.join(tmp, "raw"))
+            stack = bands.masked(cloud, os.path.join(tmp, "masked"))
+            del bands
+        else:
+            stack = load_stack(pipeline.daily_maps(con, results, region["bbox"], temporal_extent, cloud), tmp)
+        write_geotiff(stack, target)
+        del stack
+    return target
+
+
+# One region in a worker process: its time series, and its maps written to maps_folder
+def run_region(region, cache, maps_folder=None, cloud=0.5, window=31, local=False):
+    con, results = _worker(cache)
+    started = time.perf_counter()
+    df = region_series(con, results, region, cloud, window, local)
+    if maps_folder is not None:
+        region_maps(con, results, region, os.path.join(maps_folder, region["name"] + ".tif"), cloud, local)
+    return df, time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute NO2 time series and daily maps of many regions")
+    parser.add_argument("regions", help="CSV file with name, west, south, east, north, start, end")
+    parser.add_argument("--out", default="reports", help="output folder")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--cache", default="cache/results", help="result cache shared with the dashboard")
+    parser.add_argument("--cloud", type=float, default=0.5, help="cloud fraction threshold")
+    parser.add_argument("--window", type=int, default=31, help="moving average window in days")
+    parser.add_argument("--no-maps", action="store_true", help="only write the time series")
+    parser.add_argument("--local-masking", action="store_true", help="mask clouds and fill gaps locally on the raw bands")
+    args = parser.parse_args(argv)
+
+    import pandas as pd
+
+    regions = read_regions(args.regions)
+    names = [region["name"] for region in regions]
+    if len(set(names)) != len(names):
+        parser.error("region names must be unique")
+    maps_folder = None if args.no_maps else os.path.join(args.out, "maps")
+    os.makedirs(maps_folder or args.out, exist_ok=True)
+
+    frames, failed = [], []
+    # Spawned, as the tile downloads of a worker run on threads
+    with ProcessPoolExecutor(max_workers=max(args.workers, 1), mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(run_region, region, args.cache, maps_folder, args.cloud, args.window, args.local_masking): region["name"]
+                   for region in regions}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                df, seconds = future.result()
+            except Exception as e:
+                failed.append(name)
+                print(name, "failed:", e, file=sys.stderr)
+                continue
+            frames.append(df)
+            print(name, "done in {:.1f} s".format(seconds))
+
+    if frames:
+        pd.concat(frames, ignore_index=True).to_parquet(os.path.join(args.out, "time-series.parquet"), index=False)
+    print(len(frames), "of", len(regions), "regions written to", args.out)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+# End-to-end latency benchmark of the three dashboard tabs
+#
+# Runs every tab's pipeline against the local stand-in backend (see backends.py)
+# and times it stage by stage: backend download, parsing, rendering, encoding.
+#
+#   python benchmarks/bench_tabs.py --latency 0.5 --repeat 3 --json bench.json
+#   python benchmarks/bench_tabs.py --baseline bench.json --tolerance 0.25
+#   python benchmarks/bench_tabs.py --tile 0.5 --latency 0.5
+#
+# With --baseline the script exits with status 1 when a stage got slower than
+# the baseline by more than the tolerance, so it can guard against regressions in CI.
+import argparse, datetime, io, json, os, statistics, sys, tempfile, time
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import analytics
+import backends
+import pipeline
+import tiling
+from cache import ResultCache
+from raster import load_stack
+from frames import FrameRenderer, render_frames
+from stations import StationData
+import video
+
+BBOX = (11.0, 46.1, 12.2, 47.1)
+START, END = datetime.date(2019, 5, 1), datetime.date(2019, 8, 31)
+
+timings = {}
+
+
+@contextmanager
+def stage(tab, name):
+    start = time.perf_counter()
+    yield
+    timings.setdefault(tab + "/" + name, []).append(time.perf_counter() - start)
+
+
+def time_series(con, folder, results, tile=None):
+    import pandas as pd
+    from matplotlib.figure import Figure
+
+    # Download and parsing of every tile, and combining them
+    series = {}
+    for reducer in ("mean", "max"):
+        with stage("time-series", "download-" + reducer):
+            series[reducer.capitalize()] = pipeline.aggregate(con, results, BBOX, START, END, reducer, max_size=tile)
+
+    with stage("time-series", "parse"):
+        ts_df = pd.DataFrame(series)
+
+    with stage("time-series", "analytics"):
+        ts_df["MA"] = analytics.moving_average(ts_df["Mean"], 31)
+        ts_df["Rolling Max"] = analytics.rolling_max(ts_df["Mean"], 31)
+        ts_df["Rolling P90"] = analytics.rolling_percentile(ts_df["Mean"], 90, 31)
+        ts_df["Anomaly"] = analytics.anomaly(ts_df["Mean"], ts_df["MA"])
+
+    with stage("time-series", "stations"):
+        ts_df["Local"] = StationData(os.path.join(ROOT, "data", "rshiny_NO2_TM75_2017-2022.xlsx")).series(START, END)
+
+    with stage("time-series", "render"):
+        fig = Figure(figsize=(16, 12))
+        ts_df.plot(ax=fig.subplots())
+        fig.savefig(io.BytesIO(), format="png")
+
+
+# Parsing a multi-year aggregate result: the JSON the first time, its binary copy afterwards
+def parse(con, folder, results, years=5):
+    from series import load_aggregate
+
+    end = START + datetime.timedelta(days=365 * years)
+    datacube = pipeline.no2_cube(con, tiling.extent(BBOX), pipeline.temporal_extent(START, end))
+    path = results.download(datacube.aggregate_spatial(geometries=tiling.extent(BBOX), reducer="mean"), os.path.join(folder, "years.json"))
+    with stage("time-series", "parse-json"):
+        load_aggregate(path)
+    with stage("time-series", "parse-binary"):
+        load_aggregate(path)
+
+
+def map_maker(con, folder, results, tile=None, slices=30):
+    from matplotlib.figure import Figure
+
+    with stage("map-maker", "download"):
+        input_folder = pipeline.daily_maps(con, results, BBOX, pipeline.temporal_extent(START, END), max_size=tile)
+
+    with stage("map-maker", "load-stack"):
+        stack = load_stack(input_folder, os.path.join(folder, "map-stack"))
+
+    # Exploring the timeframe: every slice comes from the stack in memory
+    for day in stack.dates[::max(len(stack) // slices, 1)][:slices]:
+        with stage("map-maker", "read"):
+            image = stack.frame(stack.index(day))
+
+        with stage("map-maker", "render"):
+            fig = Figure()
+            ax = fig.subplots()
+            im = ax.imshow(image, cmap="viridis", vmin=image.min(), vmax=image.max())
+            fig.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
+            fig.savefig(io.BytesIO(), format="png")
+
+
+def animation(con, folder, results, days, fmt, tile=None):
+    end = datetime.date(2019, 7, 1) + datetime.timedelta(days=days)
+    with stage("animation", "download"):
+        input_folder = pipeline.daily_maps(con, results, BBOX, ["2019-07-01", str(end)], max_size=tile)
+
+    with stage("animation", "load-stack"):
+        stack = load_stack(input_folder, os.path.join(folder, "stack"))
+        vmin, vmax = stack.limits()
+
+    # Frames are streamed into the encoder, so rendering and encoding are timed together
+    with stage("animation", "encode-" + fmt):
+        renderer = FrameRenderer(stack.shape[1:], vmin, vmax)
+        with video.open_writer(os.path.join(folder, "spacetime-animation." + fmt), fmt, 2, renderer.lut) as writer:
+            for frame in render_frames(renderer, stack):
+                writer.append_data(frame)
+
+
+def summary():
+    return {name: {"median": statistics.median(values), "min": min(values), "runs": len(values)}
+            for name, values in sorted(timings.items())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every tab of the dashboard against the local stand-in backend")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of simulated backend latency per request")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--days", type=int, default=31, help="number of animation frames")
+    parser.add_argument("--format", default="gif", choices=list(video.FORMATS), help="animation output format")
+    parser.add_argument("--tile", type=float, help="largest tile side in degrees (default: S5P_TILE_DEGREES or 2)")
+    parser.add_argument("--warm", action="store_true", help="keep the result cache between runs")
+    parser.add_argument("--json", help="write the summary to this file")
+    parser.add_argument("--baseline", help="summary of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    con = backends.connect("fake", latency=args.latency)
+    with tempfile.TemporaryDirectory() as tmp:
+        for run in range(args.repeat):
+            folder = os.path.join(tmp, "run-" + str(run))
+            os.makedirs(folder)
+            results = ResultCache(os.path.join(tmp, "cache" if args.warm else "cache-" + str(run)))
+            time_series(con, folder, results, args.tile)
+            parse(con, folder, results)
+            map_maker(con, folder, results, args.tile)
+            animation(con, folder, results, args.days, args.format, args.tile)
+
+    result = summary()
+    for name, value in result.items():
+        print("{:<28} {:>9.4f} s (min {:.4f}, {} runs)".format(name, value["median"], value["min"], value["runs"]))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = [name for name, value in result.items()
+                  if name in baseline and value["median"] > baseline[name]["median"] * (1 + args.tolerance)]
+        for name in slower:
+            print("REGRESSION", name, round(baseline[name]["median"], 4), "->", round(result[name]["median"], 4))
+        sys.exit(1 if slower else 0)
+
+
+if __name__ == "__main__":
+    main()
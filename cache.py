@@ -0,0 +1,216 @@
+# On-disk cache for openEO results
+#
+# Every entry is a folder named after the hash of the normalized process graph
+# (bbox, temporal extent, bands, cloud threshold, reducer all live in the graph),
+# so an identical request is answered by a local copy instead of a new backend
+# round-trip. The cache is bounded in size and evicts the least recently used
+# entries first.
+import hashlib, json, os, shutil, threading, time, uuid
+from contextlib import nullcontext
+from jobs import run_batch_job
+
+
+# Round floats so 11.0 and 11.000000001 coming from the numeric inputs share a key
+def normalize(value, digits=6):
+    if isinstance(value, float):
+        return round(value, digits)
+    if isinstance(value, dict):
+        return {str(k): normalize(v, digits) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize(v, digits) for v in value]
+    return value
+
+
+# Seconds after which a temporary download folder is taken for a leftover of a crash,
+# even if a process with its pid is running
+STALE_AFTER = 24 * 3600
+
+
+def graph_key(graph, **extra):
+    payload = json.dumps(normalize({"graph": graph, **extra}), sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+
+    def __init__(self, root="cache", max_bytes=2 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # key -> lock held while its entry is being produced
+        self._producing = {}
+        os.makedirs(root, exist_ok=True)
+
+        # key -> [size in bytes, last access time], rebuilt from what is on disk
+        self._entries = {}
+        for key in os.listdir(root):
+            path = os.path.join(root, key)
+            if key.startswith("."):
+                # Downloads in progress in other processes sharing the cache (e.g. batch workers) are kept
+                if self._stale(path, key):
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            if not os.path.isdir(path):
+                continue
+            self._entries[key] = [self._folder_size(path), os.path.getmtime(path)]
+
+    def key(self, datacube, **extra):
+        return graph_key(datacube.flat_graph(), **extra)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": sum(size for size, _ in self._entries.values()),
+                "max_bytes": self.max_bytes,
+            }
+
+    # Synchronous download of a single result file (e.g. JSON time series, TIF map)
+    def download(self, datacube, target, **extra):
+        shutil.copyfile(self.file(datacube, os.path.basename(target), **extra), target)
+        return target
+
+    # Path of the cached result file, downloading it on a miss
+    def file(self, datacube, name, **extra):
+        key = self.key(datacube, **extra)
+        folder = self.fetch(key, lambda tmp: datacube.download(os.path.join(tmp, name)))
+        return os.path.join(folder, name)
+
+    # Folder of the cached batch job results, running the job on a miss;
+    # stage(name) may return a context manager timing the job's "backend-queue" and "download" stages,
+    # and with a cancelled event the job is polled and stopped once the event is set
+    def job_folder(self, datacube, stage=None, cancelled=None, **extra):
+        key = self.key(datacube, batch=True, **extra)
+        stage = stage or (lambda name: nullcontext())
+
+        def run_job(tmp):
+            job = datacube.create_job()
+            print("Starting the job")
+            with stage("backend-queue"):
+                if cancelled is None:
+                    job.start_and_wait()
+                else:
+                    run_batch_job(job, cancelled)
+            with stage("download") as span:
+                job.get_results().download_files(tmp)
+                if span is not None:
+                    span.bytes = self._folder_size(tmp)
+
+        return self.fetch(key, run_job)
+
+    # Return the folder holding the entry for key, calling produce(folder) on a miss;
+    # threads asking for a key that is being produced wait for it instead of producing it again
+    def fetch(self, key, produce):
+        folder = self.path(key)
+        with self._lock:
+            if self._hit(key):
+                return folder
+            producing = self._producing.setdefault(key, threading.Lock())
+
+        with producing:
+            with self._lock:
+                if self._hit(key):
+                    return folder
+                self.misses += 1
+            try:
+                self._produce(key, produce)
+            finally:
+                with self._lock:
+                    self._producing.pop(key, None)
+        return folder
+
+    def _hit(self, key):
+        if key in self._entries and os.path.isdir(self.path(key)):
+            self.hits += 1
+            self._touch(key)
+            return True
+        return False
+
+    def _produce(self, key, produce):
+        folder = self.path(key)
+
+        # Download into a private folder first, so readers never see partial results
+        tmp = os.path.join(self.root, "." + key + "-" + str(os.getpid()) + "-" + uuid.uuid4().hex)
+        os.makedirs(tmp)
+        try:
+            produce(tmp)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        with self._lock:
+            try:
+                os.replace(tmp, folder)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+                # Someone else (e.g. another batch worker process) stored the same result in the meantime
+                shutil.rmtree(tmp, ignore_errors=True)
+            self._entries[key] = [self._folder_size(folder), time.time()]
+            self._touch(key)
+            self._evict(keep=key)
+
+    # Count the files added to an entry after it was stored, e.g. the overviews next to its
+    # GeoTIFFs or the binary copy of a JSON result, and evict others if it outgrew the cache
+    def grow(self, folder):
+        key = os.path.basename(os.path.normpath(folder))
+        if os.path.abspath(self.path(key)) != os.path.abspath(folder):
+            return
+        with self._lock:
+            if key in self._entries and os.path.isdir(folder):
+                self._entries[key][0] = self._folder_size(folder)
+                self._evict(keep=key)
+
+    def _touch(self, key):
+        now = time.time()
+        self._entries[key][1] = now
+        os.utime(self.path(key), (now, now))
+
+    def _evict(self, keep=None):
+        total = sum(size for size, _ in self._entries.values())
+        for key in sorted(self._entries, key=lambda k: self._entries[k][1]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self._entries[key][0]
+            self._remove(key)
+            self.evictions += 1
+
+    def _remove(self, key):
+        del self._entries[key]
+        shutil.rmtree(self.path(key), ignore_errors=True)
+
+    # Temporary folder .<key>-<pid>-<uuid> of a process that is gone, or older than STALE_AFTER
+    @staticmethod
+    def _stale(path, name):
+        try:
+            if time.time() - os.path.getmtime(path) > STALE_AFTER:
+                return True
+        except OSError:
+            return False
+        parts = name.split("-")
+        if len(parts) < 3 or not parts[-2].isdigit():
+            return False
+        try:
+            os.kill(int(parts[-2]), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    @staticmethod
+    def _folder_size(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
@@ -0,0 +1,115 @@
+# Cloud masking and gap filling of the raw Sentinel-5P bands, done locally
+#
+# With S5P_LOCAL_MASKING=1 the tabs download the raw NO2 and CLOUD_FRACTION
+# bands of a cube once (a two-band GeoTIFF per day, cached whatever the
+# threshold) and mask and interpolate them here with NumPy, like the backend's
+# mask and array_interpolate_linear: NO2 is dropped where the cloud fraction
+# reaches the threshold, and every gap is filled linearly over time from the
+# nearest valid days before and after it (gaps at the start or the end of the
+# timeframe stay empty). Another threshold is a local computation then, not a
+# new backend job.
+import os
+import numpy as np
+from raster import RasterStack, load_stack
+
+# Bands of the raw GeoTIFFs
+NO2, CLOUD_FRACTION = 1, 2
+
+# Cells of the (T, Y, X) blocks masked and interpolated at once
+BLOCK = 1 << 22
+
+
+# Linear interpolation of the NaN gaps of data along its first (time) axis
+def interpolate_linear(data):
+    n = len(data)
+    t = np.arange(n, dtype="int32").reshape((-1,) + (1,) * (data.ndim - 1))
+    present = ~np.isnan(data)
+    before = np.maximum.accumulate(np.where(present, t, -1), axis=0)
+    after = np.minimum.accumulate(np.where(present, t, n)[::-1], axis=0)[::-1]
+    inside = (before >= 0) & (after < n)
+    before, after = np.clip(before, 0, n - 1), np.clip(after, 0, n - 1)
+    lo = np.take_along_axis(data, before, axis=0)
+    hi = np.take_along_axis(data, after, axis=0)
+    weight = (t - before) / np.maximum(after - before, 1)
+    return np.where(inside, lo + (hi - lo) * weight, np.nan)
+
+
+class RawBands:
+
+    def __init__(self, no2, cloud_fraction):
+        self.no2 = no2
+        self.cloud_fraction = cloud_fraction
+
+    def __len__(self):
+        return len(self.no2)
+
+    @property
+    def dates(self):
+        return self.no2.dates
+
+    @property
+    def shape(self):
+        return self.no2.shape
+
+    def index(self, date):
+        return self.no2.index(date)
+
+    # Where NO2 is valid and not masked by the threshold; cells without a cloud fraction
+    # are kept, as the backend's mask does
+    def kept(self, threshold, rows=slice(None)):
+        cloudy = self.cloud_fraction.valid[:, rows] & (self.cloud_fraction.data[:, rows] >= threshold)
+        return self.no2.valid[:, rows] & ~cloudy
+
+    # Masked (Y, X) array of one day at the threshold, interpolated from the days
+    # around it, without masking the rest of the stack
+    def frame(self, index, threshold):
+        kept = self.kept(threshold)
+        data = self.no2.data
+        inside = kept[:index + 1].any(axis=0) & kept[index:].any(axis=0)
+        before = (index - kept[index::-1].argmax(axis=0))[None]
+        after = (index + kept[index:].argmax(axis=0))[None]
+        lo = np.take_along_axis(data, before, axis=0)[0].astype("float64")
+        hi = np.take_along_axis(data, after, axis=0)[0].astype("float64")
+        image = lo + (hi - lo) * (index - before[0]) / np.maximum(after[0] - before[0], 1)
+        return np.ma.MaskedArray(image, mask=~inside)
+
+    # Stack of the masked and interpolated NO2 at the threshold, stored in folder
+    def masked(self, threshold, folder):
+        shape = self.shape
+        os.makedirs(folder, exist_ok=True)
+        data = np.lib.format.open_memmap(os.path.join(folder, "data.npy"), mode="w+", dtype="float32", shape=shape)
+        valid = np.lib.format.open_memmap(os.path.join(folder, "valid.npy"), mode="w+", dtype="bool", shape=shape)
+        step = max(1, BLOCK // max(shape[0] * shape[2], 1))
+        for y in range(0, shape[1], step):
+            rows = slice(y, y + step)
+            filled = interpolate_linear(np.where(self.kept(threshold, rows), self.no2.data[:, rows], np.nan))
+            data[:, rows] = filled
+            valid[:, rows] = ~np.isnan(filled)
+        data.flush()
+        valid.flush()
+        del data, valid
+        return RasterStack(folder, self.dates, self.no2.transform, self.no2.crs)
+
+
+# Raw bands of the daily two-band GeoTIFFs in input_folder, stored in folder
+# (same arguments as load_stack)
+def load_bands(input_folder, folder, bounds=None, dates=None, max_size=None):
+    no2 = load_stack(input_folder, os.path.join(folder, "no2"), bounds=bounds, dates=dates, max_size=max_size, band=NO2)
+    cloud_fraction = load_stack(input_folder, os.path.join(folder, "cloud"), bounds=bounds, dates=dates,
+                                max_size=max_size, band=CLOUD_FRACTION)
+    return RawBands(no2, cloud_fraction)
+
+
+# Daily "mean", "max" or "count" of the valid cells of a stack, like an aggregate_spatial result
+def reduce(stack, reducer):
+    import pandas as pd
+
+    values = np.full(len(stack), np.nan)
+    for i in range(len(stack)):
+        cells = stack.data[i][stack.valid[i]]
+        if reducer == "count":
+            values[i] = len(cells)
+        elif len(cells):
+            values[i] = cells.max() if reducer == "max" else cells.astype("float64").mean()
+    index = pd.to_datetime(stack.labels, utc=True)
+    return pd.Series(values, index=index, dtype="float64")
@@ -0,0 +1,91 @@
+# Store of the NO2 cubes already downloaded as daily maps
+#
+# The Map Maker and the Spacetime Animation download the masked and
+# gap-filled cube of a bbox as one GeoTIFF per day. Every such folder in the
+# result cache is recorded here with its bbox, cloud threshold and days, so a
+# later query of any tab that lies inside it (same threshold, a bbox within
+# it, every day present) is answered from the local files: time series are
+# reduced over the pixels of the bbox with NumPy, and maps are cropped from
+# the daily GeoTIFFs, without a new backend request.
+#
+# Local means and maxima are taken over the pixels whose centres lie in the
+# bbox, so they can differ slightly from the backend's aggregate_spatial at
+# the border of the polygon.
+import datetime, json, os, threading
+import numpy as np
+import pandas as pd
+from raster import tif_files, valid_mask, window
+
+# Bboxes are compared with this tolerance, in degrees
+EPSILON = 1e-6
+
+
+class CubeStore:
+
+    def __init__(self, path="cache/cubes.json"):
+        self.path = path
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._entries = []
+        if os.path.exists(path):
+            with open(path) as f:
+                self._entries = json.load(f)
+
+    # Record the daily maps in folder as the cube of bbox and cloud threshold
+    def add(self, bbox, cloud, folder):
+        days = sorted(tif_files(folder))
+        if not days:
+            return
+        entry = {"bbox": [float(v) for v in bbox], "cloud": float(cloud), "folder": folder,
+                 "days": [day.isoformat() for day in days]}
+        with self._lock:
+            self._entries = [e for e in self._entries if e["folder"] != folder and os.path.isdir(e["folder"])]
+            self._entries.append(entry)
+            self._save()
+
+    # Folder of a stored cube holding bbox for every day in start..end (inclusive), or None
+    def find(self, bbox, cloud, start, end):
+        w, s, e, n = bbox
+        days = {(start + datetime.timedelta(days=i)).isoformat() for i in range((end - start).days + 1)}
+        with self._lock:
+            for entry in reversed(self._entries):
+                ew, es, ee, en = entry["bbox"]
+                if (abs(entry["cloud"] - cloud) < EPSILON and ew <= w + EPSILON and es <= s + EPSILON
+                        and ee >= e - EPSILON and en >= n - EPSILON and days <= set(entry["days"])
+                        and os.path.isdir(entry["folder"])):
+                    self.hits += 1
+                    return entry["folder"]
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {"cubes": len(self._entries), "hits": self.hits}
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(tmp, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, self.path)
+
+
+# Daily "mean", "max" or "count" of the valid pixels of bbox over start..end
+# (inclusive), from a folder of daily maps, like an aggregate_spatial result
+def series(folder, bbox, start, end, reducer):
+    import rasterio
+
+    files = tif_files(folder)
+    days = [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+    days = [day for day in days if day in files]
+    values = np.full(len(days), np.nan)
+    for i, day in enumerate(days):
+        with rasterio.open(files[day]) as src:
+            rows, cols = window(src.transform, src.shape, bbox)
+            data = src.read(1, window=((rows.start, rows.stop), (cols.start, cols.stop))).astype("float64")
+            valid = valid_mask(data, src.nodata)
+        if reducer == "count":
+            values[i] = valid.sum()
+        elif valid.any():
+            values[i] = data[valid].max() if reducer == "max" else data[valid].mean()
+    index = pd.to_datetime([day.isoformat() for day in days], utc=True)
+    return pd.Series(values, index=index, dtype="float64")
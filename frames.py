@@ -0,0 +1,110 @@
+# Frame rendering for the Spacetime Animation
+#
+# The figure layout (axes, colorbar, ticks) is drawn once with matplotlib.
+# Every frame is then only a colormap lookup on the masked NumPy array, pasted
+# into a copy of that background together with its date, so frames can be
+# rendered in parallel worker processes (reading the memory-mapped stack) and
+# handed over in memory.
+import collections, multiprocessing, os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+_pool = None
+
+
+# Shared process pool, started on first use (spawned, as the app forks from threads otherwise)
+def pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+class FrameRenderer:
+
+    def __init__(self, shape, vmin, vmax, cmap="viridis", title="NO2 Concentration at ", figsize=(10, 7.5), dpi=100):
+        from matplotlib import colormaps
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.vmin, self.vmax, self.title = float(vmin), float(vmax), title
+        self.lut = (colormaps[cmap](np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
+
+        # Draw the static part of the figure once, with an empty image of the right shape
+        fig = Figure(figsize=figsize, dpi=dpi)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.subplots()
+        im = ax.imshow(np.ma.masked_all(shape), cmap=cmap, vmin=self.vmin, vmax=self.vmax)
+        fig.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
+        title = ax.set_title(self.title + "0000-00-00")
+        canvas.draw()
+        renderer = canvas.get_renderer()
+
+        # Pixel boxes (row/column, from the top left) of the image and the title
+        height = int(canvas.get_width_height()[1])
+        box = im.get_window_extent(renderer)
+        self.box = (height - int(round(box.y1)), height - int(round(box.y0)), int(round(box.x0)), int(round(box.x1)))
+        text = title.get_window_extent(renderer)
+        self.title_box = (height - int(round(text.y1)), height - int(round(text.y0)), int(round(text.x0)), int(round(text.x1)))
+        self.fontsize = title.get_fontsize() * dpi / 72
+        title.set_visible(False)
+        canvas.draw()
+        self.background = np.asarray(canvas.buffer_rgba())[..., :3].copy()
+
+        # Nearest neighbour index from the image box back to array cells
+        top, bottom, left, right = self.box
+        self.rows = (np.arange(bottom - top) * shape[0] // max(bottom - top, 1)).clip(0, shape[0] - 1)
+        self.cols = (np.arange(right - left) * shape[1] // max(right - left, 1)).clip(0, shape[1] - 1)
+
+    # Colormap lookup on the array: masked or NaN cells stay white, like in imshow
+    def colorize(self, image):
+        data = np.ma.filled(np.ma.masked_invalid(image).astype("float64"), np.nan)
+        scale = 255 / (self.vmax - self.vmin) if self.vmax > self.vmin else 0
+        index = np.nan_to_num((data - self.vmin) * scale).clip(0, 255).astype(np.uint8)
+        rgb = self.lut[index]
+        rgb[np.isnan(data)] = 255
+        return rgb
+
+    def render(self, image, label):
+        from PIL import Image, ImageDraw, ImageFont
+
+        frame = self.background.copy()
+        top, bottom, left, right = self.box
+        frame[top:bottom, left:right] = self.colorize(image)[self.rows[:, None], self.cols[None, :]]
+
+        # Date title, centred where matplotlib would have put it
+        picture = Image.fromarray(frame)
+        draw = ImageDraw.Draw(picture)
+        try:
+            font = ImageFont.load_default(size=self.fontsize)
+        except TypeError:
+            font = ImageFont.load_default()
+        text = self.title + label
+        width = draw.textlength(text, font=font)
+        t_top, t_bottom, t_left, t_right = self.title_box
+        draw.text(((t_left + t_right - width) / 2, t_top), text, fill=(0, 0, 0), font=font)
+        return np.asarray(picture)
+
+
+def _render_chunk(renderer, stack, start, stop):
+    labels = stack.labels
+    return [renderer.render(stack.frame(i), labels[i]) for i in range(start, stop)]
+
+
+# Render every frame of a RasterStack across the process pool, yielding them in order;
+# at most window batches of frames are rendered ahead, so memory does not grow with the stack
+def render_frames(renderer, stack, processes=None, batch=8, window=None):
+    processes = processes or os.cpu_count() or 1
+    window = window or 2 * processes
+    starts = iter(range(0, len(stack), batch))
+    pending = collections.deque()
+    for start in starts:
+        pending.append(pool().submit(_render_chunk, renderer, stack, start, min(start + batch, len(stack))))
+        if len(pending) >= window:
+            break
+    while pending:
+        frames = pending.popleft().result()
+        start = next(starts, None)
+        if start is not None:
+            pending.append(pool().submit(_render_chunk, renderer, stack, start, min(start + batch, len(stack))))
+        yield from frames
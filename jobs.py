@@ -0,0 +1,163 @@
+# App-wide manager of backend downloads and batch jobs
+#
+# Identical requests (same key, i.e. the hash of the process graph) from any
+# session share one job in flight: the first submit starts it, later ones wait
+# for the same result. Every submit gets a future of its own, so a session
+# that goes away or submits again only drops its interest; a job nobody waits
+# for any more is removed from the queue, or asked to stop through its
+# cancelled event if it is already running.
+#
+# Batch jobs run on a small pool of their own. Their queue is bounded, and a
+# session may only have a few of them in flight, so one user cannot keep
+# every worker busy.
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class JobQueueFull(RuntimeError):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class _Job:
+
+    def __init__(self, key, batch):
+        self.key = key
+        self.batch = batch
+        self.cancelled = threading.Event()
+        # (session, tag) -> futures handed out to that owner
+        self.waiters = {}
+        self.future = None
+
+
+class JobManager:
+
+    def __init__(self, executor, batch_workers=2, max_queued=8, per_session=2):
+        self.executor = executor
+        self.batch_executor = ThreadPoolExecutor(max_workers=batch_workers, thread_name_prefix="batch-job")
+        self.max_queued = max_queued
+        self.per_session = per_session
+        self.started = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    # Future of fn(cancelled) for key, shared with every identical submit still in flight
+    def submit(self, key, fn, session=None, tag=None, batch=False):
+        waiter = Future()
+        with self._lock:
+            job = self._jobs.get(key)
+            # A job that was asked to stop may already be stopping on the backend, so it is
+            # left to finish on its own and a new one is started for the key
+            if job is None or job.cancelled.is_set():
+                if batch:
+                    self._check_capacity(session)
+                job = _Job(key, batch)
+                self._jobs[key] = job
+                job.waiters[(session, tag)] = [waiter]
+                job.future = (self.batch_executor if batch else self.executor).submit(self._run, job, fn)
+                self.started += 1
+            else:
+                job.waiters.setdefault((session, tag), []).append(waiter)
+                self.coalesced += 1
+        return waiter
+
+    # Future of fn(result of future), run on the download threads once future is done;
+    # an error or a cancellation of future is passed on
+    def then(self, future, fn):
+        chained = Future()
+
+        def run(done):
+            if not chained.set_running_or_notify_cancel():
+                return
+            try:
+                chained.set_result(fn(done.result()))
+            except BaseException as e:
+                chained.set_exception(e)
+
+        def landed(done):
+            if done.cancelled():
+                chained.cancel()
+            elif done.exception() is not None:
+                if chained.set_running_or_notify_cancel():
+                    chained.set_exception(done.exception())
+            else:
+                self.executor.submit(run, done)
+
+        future.add_done_callback(landed)
+        return chained
+
+    # Drop the interest of a session (or of one of its tags) in its jobs
+    def release(self, session, tag=None):
+        dropped = []
+        with self._lock:
+            for key, job in list(self._jobs.items()):
+                owners = [owner for owner in job.waiters if owner[0] == session and (tag is None or owner[1] == tag)]
+                if not owners:
+                    continue
+                for owner in owners:
+                    dropped += job.waiters.pop(owner)
+                if not job.waiters:
+                    self.cancelled += 1
+                    if job.future.cancel():
+                        del self._jobs[key]
+                    else:
+                        job.cancelled.set()
+        for waiter in dropped:
+            waiter.cancel()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._jobs),
+                "batch_in_flight": sum(job.batch for job in self._jobs.values()),
+                "started": self.started,
+                "coalesced": self.coalesced,
+                "cancelled": self.cancelled,
+            }
+
+    def _check_capacity(self, session):
+        batch = [job for job in self._jobs.values() if job.batch]
+        if len(batch) >= self.max_queued:
+            raise JobQueueFull("Too many batch jobs are queued, please try again in a few minutes")
+        if session is not None and sum(any(owner[0] == session for owner in job.waiters) for job in batch) >= self.per_session:
+            raise JobQueueFull("Only " + str(self.per_session) + " batch jobs can run at once for a session")
+
+    def _run(self, job, fn):
+        try:
+            result, error = fn(job.cancelled), None
+        except BaseException as e:
+            result, error = None, e
+        with self._lock:
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+            waiters = [waiter for waiters in job.waiters.values() for waiter in waiters]
+            job.waiters.clear()
+        for waiter in waiters:
+            if waiter.set_running_or_notify_cancel():
+                if error is None:
+                    waiter.set_result(result)
+                else:
+                    waiter.set_exception(error)
+        return result
+
+
+# Start an openEO batch job and poll it until it finishes, stopping it on the
+# backend as soon as cancelled is set
+def run_batch_job(job, cancelled, max_poll=10):
+    job.start_job()
+    poll = 0.5
+    while True:
+        status = job.status()
+        if status == "finished":
+            return job
+        if status in ("error", "canceled"):
+            raise RuntimeError("Batch job " + str(getattr(job, "job_id", "")) + " ended with status " + status)
+        if cancelled.wait(poll):
+            job.stop_job()
+            raise JobCancelled()
+        poll = min(poll * 1.5, max_poll)
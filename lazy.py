@@ -0,0 +1,23 @@
+# Objects that are only built when they are first used
+#
+# Lets app.py declare its shared stores at module level without importing
+# pandas, NumPy or matplotlib before a session actually needs them.
+import threading
+
+
+class Lazy:
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory()
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
@@ -0,0 +1,123 @@
+# Stage-level timing of the dashboard
+#
+# Each handler wraps its stages (backend wait, download, parse, render,
+# encode) in metrics.span(...). A span is tagged with the tab and session and
+# kept in a short log of recent spans; its duration, and the downloaded bytes
+# if set, are added to histograms per tab and stage. render() returns those
+# histograms in the Prometheus text format for the /metrics route.
+import collections, hashlib, math, threading, time
+from contextlib import contextmanager
+
+SECONDS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, math.inf)
+BYTES = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, math.inf)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    # Cumulative counts per upper bound, as Prometheus expects them
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield ("+Inf" if math.isinf(bound) else repr(float(bound))), total
+
+
+# Short hash of a session id: it groups the spans of a session without giving away
+# the id, which opens the session's dynamic routes (e.g. its animation)
+def session_tag(session):
+    if session is None:
+        return None
+    return hashlib.sha256(str(session).encode("utf-8")).hexdigest()[:12]
+
+
+class Span:
+
+    def __init__(self, stage, tab, session, tags):
+        self.stage = stage
+        self.tab = tab
+        self.session = session
+        self.tags = tags
+        self.bytes = None
+        self.start = time.time()
+        self.seconds = None
+        self.error = None
+
+    def as_dict(self):
+        return {"stage": self.stage, "tab": self.tab, "session": session_tag(self.session), "start": self.start,
+                "seconds": self.seconds, "bytes": self.bytes, "error": self.error, **self.tags}
+
+
+class Metrics:
+
+    def __init__(self, keep=1000):
+        self.seconds = {}
+        self.bytes = {}
+        self.errors = collections.Counter()
+        self.recent = collections.deque(maxlen=keep)
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage, tab, session=None, **tags):
+        span = Span(stage, tab, session, tags)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            self.record(span)
+
+    def record(self, span):
+        key = (span.tab, span.stage)
+        with self._lock:
+            self.seconds.setdefault(key, Histogram(SECONDS)).observe(span.seconds)
+            if span.bytes is not None:
+                self.bytes.setdefault(key, Histogram(BYTES)).observe(span.bytes)
+            if span.error is not None:
+                self.errors[key] += 1
+            self.recent.append(span)
+
+    # Values read at scrape time, e.g. the result cache statistics
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def spans(self):
+        with self._lock:
+            return [span.as_dict() for span in self.recent]
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, histograms, help_text in (
+                    ("s5p_stage_seconds", self.seconds, "Duration of a dashboard stage"),
+                    ("s5p_stage_bytes", self.bytes, "Bytes downloaded in a dashboard stage")):
+                lines += ["# HELP " + name + " " + help_text, "# TYPE " + name + " histogram"]
+                for (tab, stage), histogram in sorted(histograms.items()):
+                    labels = 'tab="' + tab + '",stage="' + stage + '"'
+                    for bound, count in histogram.cumulative():
+                        lines.append(name + "_bucket{" + labels + ',le="' + bound + '"} ' + str(count))
+                    lines.append(name + "_sum{" + labels + "} " + repr(histogram.sum))
+                    lines.append(name + "_count{" + labels + "} " + str(histogram.count))
+            lines += ["# HELP s5p_stage_errors_total Stages that raised an error", "# TYPE s5p_stage_errors_total counter"]
+            for (tab, stage), count in sorted(self.errors.items()):
+                lines.append('s5p_stage_errors_total{tab="' + tab + '",stage="' + stage + '"} ' + str(count))
+        for name, read in sorted(self.gauges.items()):
+            lines += ["# TYPE " + name + " gauge", name + " " + repr(float(read()))]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,220 @@
+# NO2 processing pipeline shared by the dashboard and the batch runs
+#
+# Builds the masked and gap-filled Sentinel-5P NO2 cube of a bbox and turns it
+# into the results the tabs show: daily mean and max series of the region and
+# folders of daily GeoTIFFs. Nothing here reads Shiny inputs, so the same
+# calls run from the app, the benchmarks and batch.py.
+#
+# stage(name) may return a context manager timing a stage ("download-mean",
+# "backend-queue", "download", ...), as in ResultCache.job_folder. With a
+# CubeStore (see cubes.py), daily maps are recorded in it and queries it
+# covers are answered from them locally.
+#
+# With local=True (S5P_LOCAL_MASKING=1 in the app) the raw NO2 and
+# CLOUD_FRACTION bands are downloaded instead, and masked and gap-filled
+# locally (see clouds.py), so their cached download serves every threshold.
+import datetime, os, tempfile
+from contextlib import nullcontext
+import tiling
+
+DAY = datetime.timedelta(days=1)
+
+LOCAL_MASKING = os.environ.get("S5P_LOCAL_MASKING", "0") == "1"
+
+
+# openEO temporal extents exclude the end date; start and end are both included here
+def temporal_extent(start, end):
+    return [str(start), str(end + DAY)]
+
+
+# Days start..end, both included
+def days(start, end):
+    return [start + i * DAY for i in range((end - start).days + 1)]
+
+
+# NO2 of the extent, masked where the cloud fraction reaches the threshold, with
+# the gaps filled by linear interpolation over time
+def no2_cube(con, extent, temporal_extent, cloud=0.5):
+    # datacube = con.load_collection(
+    #   "TERRASCOPE_S5P_L3_NO2_TD_V1",
+    #   spatial_extent = extent,
+    #   temporal_extent = temporal_extent
+    #   )
+    datacube = con.load_collection(
+        "SENTINEL_5P_L2",
+        spatial_extent=extent,
+        temporal_extent=temporal_extent,
+        bands=["NO2"]
+        )
+
+    datacube_cloud = con.load_collection(
+        "SENTINEL_5P_L2",
+        spatial_extent=extent,
+        temporal_extent=temporal_extent,
+        bands=["CLOUD_FRACTION"]
+        )
+
+    # mask for cloud cover
+    def threshold_(data):
+        return data[0].gte(cloud)
+
+    # apply the threshold to the cube and mask the cloud cover with it
+    datacube = datacube.mask(datacube_cloud.apply(process=threshold_))
+
+    # Fill Gaps
+    return datacube.apply_dimension(dimension="t", process="array_interpolate_linear")
+
+
+# Raw NO2 and CLOUD_FRACTION bands of the extent, neither masked nor gap-filled
+def raw_cube(con, extent, temporal_extent):
+    return con.load_collection(
+        "SENTINEL_5P_L2",
+        spatial_extent=extent,
+        temporal_extent=temporal_extent,
+        bands=["NO2", "CLOUD_FRACTION"]
+        )
+
+
+# Daily "mean" or "max" series of bbox over the days start..end; a large bbox is
+# fetched tile by tile, side by side, and the tiles are combined
+def aggregate(con, results, bbox, start, end, reducer, cloud=0.5, stage=None, max_size=None, cubes=None, local=False):
+    from series import read_aggregate_json
+
+    stage = stage or (lambda name: nullcontext())
+
+    folder = cubes.find(bbox, cloud, start, end) if cubes is not None else None
+    if folder is not None:
+        from cubes import series
+        with stage("local-" + reducer):
+            return series(folder, bbox, start, end, reducer)
+
+    # The raw bands of the whole bbox, masked and reduced here
+    if local:
+        folder = raw_maps(con, results, bbox, temporal_extent(start, end), stage, max_size=max_size)
+        with stage("local-" + reducer):
+            return local_series(folder, bbox, start, end, reducer, cloud)
+
+    def fetch(tile, name):
+        extent = tiling.extent(tile)
+        datacube = no2_cube(con, extent, temporal_extent(start, end), cloud)
+        datacube = datacube.aggregate_spatial(geometries=extent, reducer=name)
+        with stage("download-" + name) as span:
+            path = results.file(datacube, "time-series-" + name + "-" + str(start) + "-" + str(end) + ".json")
+            if span is not None:
+                span.bytes = os.path.getsize(path)
+        series = read_aggregate_json(path)
+        # The binary copy of the result is stored next to it
+        results.grow(os.path.dirname(path))
+        return series
+
+    return tiling.aggregate(fetch, bbox, reducer, max_size)
+
+
+# Daily "mean" or "max" series of bbox over start..end from a folder of raw bands, masked at cloud
+def local_series(folder, bbox, start, end, reducer, cloud):
+    from clouds import load_bands, reduce
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bands = load_bands(folder, tmp, bounds=bbox, dates=days(start, end))
+        return reduce(bands.masked(cloud, os.path.join(tmp, "masked")), reducer)
+
+
+# Fetch the days of start..end missing from the series store, for the mean and the max, through
+# the job manager, under keys shared by every session; each result is merged into the store as it
+# lands. Returns the store keys per reducer and the futures of the fetches. Aggregates are fetched
+# month by month; with local=True the raw bands of every gap come from one batch job instead.
+def fetch_series(con, results, jobs, series_store, bbox, start, end, cloud=0.5, session=None, tag=None,
+                 stage=None, cubes=None, local=False):
+    from concurrent.futures import Future
+    from jobs import JobQueueFull
+    from series import monthly_chunks
+
+    def fetch_chunk(key, reducer, a, b):
+        series_store.merge(key, a, b, aggregate(con, results, bbox, a, b, reducer, cloud, stage, cubes=cubes))
+
+    def reduce_gap(folder, key, reducer, a, b):
+        with (stage or (lambda name: nullcontext()))("local-" + reducer):
+            series_store.merge(key, a, b, local_series(folder, bbox, a, b, reducer, cloud))
+
+    keys = {reducer: series_store.key(bbox, cloud, reducer) for reducer in ("mean", "max")}
+    futures = []
+    for reducer, key in keys.items():
+        for a, b in series_store.missing(key, start, end):
+            if not local:
+                futures += [jobs.submit("time-series/" + key + "/" + str(c) + "/" + str(d),
+                                        lambda cancelled, chunk=(key, reducer, c, d): fetch_chunk(*chunk), session, tag)
+                            for c, d in monthly_chunks(a, b)]
+                continue
+            extent = temporal_extent(a, b)
+            try:
+                raw = jobs.submit(raw_key(con, results, bbox, extent),
+                                  lambda cancelled, extent=extent: raw_maps(con, results, bbox, extent, stage, cancelled),
+                                  session, tag, batch=True)
+            except JobQueueFull as e:
+                raw = Future()
+                raw.set_exception(e)
+            futures.append(jobs.then(raw, lambda folder, gap=(key, reducer, a, b): reduce_gap(folder, *gap)))
+    return keys, futures
+
+
+# Cache key of the daily maps, for sharing one run between everyone asking for it
+def maps_key(con, results, bbox, temporal_extent, cloud=0.5):
+    return results.key(no2_cube(con, tiling.extent(bbox), temporal_extent, cloud), batch=True)
+
+
+# Cached folder of the daily openEO_<date>Z.tif maps of bbox, from a batch job
+# (one per tile for a large bbox); with a cancelled event the jobs are stopped once it is set
+def daily_maps(con, results, bbox, temporal_extent, cloud=0.5, stage=None, cancelled=None, max_size=None, cubes=None):
+    def cube(tile):
+        return no2_cube(con, tiling.extent(tile), temporal_extent, cloud)
+
+    folder = tiling.job_folder(results, cube, bbox, stage, cancelled, max_size)
+    if cubes is not None:
+        cubes.add(bbox, cloud, folder)
+    return folder
+
+
+# Folder of the daily maps of bbox over the days start..end: a stored cube holding them, or the
+# result of a batch job run through submit(key, fn(cancelled)) -> future; with local=True the raw
+# bands, which serve every threshold
+def maps_folder(con, results, bbox, start, end, submit, cloud=0.5, stage=None, cubes=None, local=False):
+    extent = temporal_extent(start, end)
+    if local:
+        return submit(raw_key(con, results, bbox, extent),
+                      lambda cancelled: raw_maps(con, results, bbox, extent, stage, cancelled)).result()
+    folder = cubes.find(bbox, cloud, start, end) if cubes is not None else None
+    if folder is None:
+        folder = submit(maps_key(con, results, bbox, extent, cloud),
+                        lambda cancelled: daily_maps(con, results, bbox, extent, cloud, stage, cancelled, cubes=cubes)).result()
+    return folder
+
+
+# Stack in folder of those daily maps, cropped to bbox and read at most max_size pixels on a
+# side; with local=True the raw bands (a clouds.RawBands) to mask at any threshold
+def load_maps(con, results, bbox, start, end, folder, submit, cloud=0.5, stage=None, cubes=None, local=False, max_size=None):
+    from raster import load_stack
+
+    stage = stage or (lambda name: nullcontext())
+    input_folder = maps_folder(con, results, bbox, start, end, submit, cloud, stage, cubes, local)
+    with stage("load-stack"):
+        if local:
+            from clouds import load_bands
+            stack = load_bands(input_folder, folder, bounds=bbox, dates=days(start, end), max_size=max_size)
+        else:
+            stack = load_stack(input_folder, folder, bounds=bbox, dates=days(start, end), max_size=max_size)
+    # Overviews built for a decimated read are stored next to the cached maps
+    results.grow(input_folder)
+    return stack
+
+
+# Cache key of the raw bands, the same for every cloud threshold
+def raw_key(con, results, bbox, temporal_extent):
+    return results.key(raw_cube(con, tiling.extent(bbox), temporal_extent), batch=True)
+
+
+# Cached folder of the daily two-band (NO2, CLOUD_FRACTION) openEO_<date>Z.tif maps of bbox
+def raw_maps(con, results, bbox, temporal_extent, stage=None, cancelled=None, max_size=None):
+    def cube(tile):
+        return raw_cube(con, tiling.extent(tile), temporal_extent)
+
+    return tiling.job_folder(results, cube, bbox, stage, cancelled, max_size)
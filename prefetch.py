@@ -0,0 +1,156 @@
+# Scheduled prefetch of the popular regions
+#
+# Most views ask for a few regions (the default South Tyrol bbox above all)
+# and for the latest days. The Prefetcher reads those regions from a JSON
+# file and fetches their time series and daily maps at startup and then
+# every interval seconds. It uses the same job manager, series store, cube
+# store and result cache as the tabs. A first view of such a region is then
+# answered locally, and a view asked for while the prefetch of it is running
+# waits for that job instead of starting its own.
+#
+# The file holds {"regions": [...]}. A region is {"name", "bbox": [w, s, e, n]}
+# with "start" and "end" (YYYY-MM-DD), or with "days" for the last days up to
+# today, and optionally "cloud" (0.5) and "maps" (true). status() tells when
+# every region was last fetched, for the /prefetch route and /metrics.
+#
+# Started with a lock file, only the worker process holding it prefetches, so
+# the workers of a node don't fetch the same regions side by side. The lock is
+# released when that process exits.
+import datetime, fcntl, json, os, threading, time
+import pipeline
+
+DAY = datetime.timedelta(days=1)
+
+
+def read_regions(path):
+    with open(path) as f:
+        regions = json.load(f)["regions"]
+    for region in regions:
+        region["bbox"] = tuple(float(v) for v in region["bbox"])
+        region.setdefault("cloud", 0.5)
+        region.setdefault("maps", True)
+    return regions
+
+
+# Inclusive (start, end) days of a region on a given day
+def date_range(region, today=None):
+    if "days" in region:
+        end = today or datetime.date.today()
+        return end - (int(region["days"]) - 1) * DAY, end
+    return datetime.date.fromisoformat(region["start"]), datetime.date.fromisoformat(region["end"])
+
+
+class Prefetcher:
+
+    def __init__(self, con, results, series_store, cubes, jobs, regions, interval=6 * 3600, local=False):
+        self.con = con
+        self.results = results
+        self.series_store = series_store
+        self.cubes = cubes
+        self.jobs = jobs
+        self.regions = regions
+        self.interval = interval
+        self.local = local
+        self.started = time.time()
+        self._state = {region["name"]: {"fetched": None, "seconds": None, "error": None, "running": False}
+                       for region in regions}
+        self.active = False
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._lock_file = None
+
+    # Prefetch now in the background, then every interval seconds (only once with interval <= 0);
+    # with a lock file, only if no other process holds it
+    def start(self, lock=None):
+        if not self.regions:
+            return
+        if lock is not None:
+            os.makedirs(os.path.dirname(lock) or ".", exist_ok=True)
+            f = open(lock, "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return
+            self._lock_file = f
+        self.active = True
+        threading.Thread(target=self._loop, name="prefetch", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            for region in self.regions:
+                if self._stop.is_set():
+                    return
+                self.run(region)
+            if self.interval <= 0 or self._stop.wait(self.interval):
+                return
+
+    # Time series and maps of one region; a failure is reported and retried on the next round
+    def run(self, region):
+        state = self._state[region["name"]]
+        with self._lock:
+            state["running"] = True
+        started = time.perf_counter()
+        start, end = date_range(region)
+        try:
+            self._series(region["bbox"], region["cloud"], start, end)
+            if region["maps"]:
+                self._maps(region["bbox"], region["cloud"], start, end)
+        except Exception as e:
+            print("Prefetch of", region["name"], "failed:", e)
+            with self._lock:
+                state["error"] = str(e)
+        else:
+            with self._lock:
+                state["fetched"], state["error"] = time.time(), None
+        finally:
+            with self._lock:
+                state["running"] = False
+                state["seconds"] = time.perf_counter() - started
+
+    # Days the series store is missing, under the same job keys as the Time-Series Analyser
+    def _series(self, bbox, cloud, start, end):
+        keys, futures = pipeline.fetch_series(self.con, self.results, self.jobs, self.series_store, bbox, start, end, cloud,
+                                              tag="prefetch", cubes=self.cubes, local=self.local)
+        for future in futures:
+            future.result()
+
+    # Daily maps under the same job key as the Map Maker, unless the cube store already holds them
+    def _maps(self, bbox, cloud, start, end):
+        pipeline.maps_folder(self.con, self.results, bbox, start, end,
+                             lambda key, fn: self.jobs.submit(key, fn, None, "prefetch", batch=True),
+                             cloud, cubes=self.cubes, local=self.local)
+
+    # Freshness of every region: when it was last fetched, how long ago, and the last error
+    def status(self):
+        now = time.time()
+        with self._lock:
+            regions = []
+            for region in self.regions:
+                state = self._state[region["name"]]
+                start, end = date_range(region)
+                regions.append({
+                    "name": region["name"], "bbox": list(region["bbox"]), "start": str(start), "end": str(end),
+                    "fetched": state["fetched"], "age": None if state["fetched"] is None else now - state["fetched"],
+                    "seconds": state["seconds"], "running": state["running"], "error": state["error"],
+                    })
+        return {"interval": self.interval, "active": self.active, "regions": regions}
+
+    # Seconds since the least recently fetched region was fetched (or since the start, if one never was);
+    # 0 in the processes that leave the prefetch to another one
+    def oldest_age(self):
+        if not self.active:
+            return 0
+        now = time.time()
+        with self._lock:
+            return max([now - (state["fetched"] or self.started) for state in self._state.values()] + [0])
+
+    # Regions whose last fetch failed or that were never fetched, in the process prefetching them
+    def stale(self):
+        if not self.active:
+            return 0
+        with self._lock:
+            return sum(state["fetched"] is None or state["error"] is not None for state in self._state.values())
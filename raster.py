@@ -0,0 +1,191 @@
+# Spacetime raster stacks
+#
+# The daily GeoTIFFs of a batch job are read once into a memory-mapped
+# (T, Y, X) array with a date index and a validity mask. Statistics, frame
+# rendering and other consumers share that buffer, and worker processes reopen
+# the same files instead of receiving copies of the data.
+#
+# Stacks that are only displayed are read decimated to about the size they are
+# shown at, from overviews built once next to the cached GeoTIFFs (an external
+# .ovr file each, so the GeoTIFF itself is not rewritten). Analysis reads the
+# GeoTIFFs at full resolution.
+import datetime, math, os, re, shutil, uuid
+import numpy as np
+
+TIF_REGEX = re.compile(r'openEO_(\d{4}-\d{2}-\d{2})Z\.tif$')
+
+# Longest side in pixels of a stack that is only displayed (a map or an animation frame)
+DISPLAY_SIZE = 800
+
+OVERVIEW_FACTORS = (2, 4, 8, 16, 32, 64)
+
+
+class RasterStack:
+
+    def __init__(self, folder, dates, transform=None, crs=None, mode="r"):
+        self.folder = folder
+        self.dates = list(dates)
+        self.transform = transform
+        self.crs = crs
+        self.data = np.load(os.path.join(folder, "data.npy"), mmap_mode=mode)
+        self.valid = np.load(os.path.join(folder, "valid.npy"), mmap_mode=mode)
+
+    # Only the folder travels to worker processes, they map the same files again
+    def __getstate__(self):
+        t = self.transform
+        transform = (t.a, t.b, t.c, t.d, t.e, t.f) if t is not None else None
+        crs = self.crs.to_wkt() if self.crs is not None else None
+        return {"folder": self.folder, "dates": self.dates, "transform": transform, "crs": crs}
+
+    def __setstate__(self, state):
+        from affine import Affine
+        from rasterio.crs import CRS
+
+        transform = Affine(*state["transform"]) if state["transform"] is not None else None
+        crs = CRS.from_wkt(state["crs"]) if state["crs"] is not None else None
+        self.__init__(state["folder"], state["dates"], transform, crs)
+
+    def __len__(self):
+        return len(self.dates)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def labels(self):
+        return [d.isoformat() for d in self.dates]
+
+    # Masked (Y, X) array of one day, a view on the shared buffer
+    def frame(self, index):
+        return np.ma.MaskedArray(self.data[index], mask=~self.valid[index])
+
+    def index(self, date):
+        return self.dates.index(date)
+
+    # Global minimum and maximum over every valid cell, without copying the stack
+    def limits(self):
+        if not self.valid.any():
+            return np.nan, np.nan
+        vmin = np.min(self.data, where=self.valid, initial=np.inf)
+        vmax = np.max(self.data, where=self.valid, initial=-np.inf)
+        return float(vmin), float(vmax)
+
+
+# Days of input_folder with the path of their openEO_YYYY-MM-DDZ.tif
+def tif_files(input_folder):
+    files = {}
+    for filename in os.listdir(input_folder):
+        match = TIF_REGEX.match(filename)
+        if match:
+            files[datetime.datetime.strptime(match.group(1), '%Y-%m-%d').date()] = os.path.join(input_folder, filename)
+    return files
+
+
+# Rows and columns of the pixels whose centres lie in bounds (w, s, e, n), at least one of each
+def window(transform, shape, bounds):
+    w, s, e, n = bounds
+    cols = (np.arange(shape[1]) + 0.5) * transform.a + transform.c
+    rows = (np.arange(shape[0]) + 0.5) * transform.e + transform.f
+    cols = np.flatnonzero((cols >= w) & (cols <= e))
+    rows = np.flatnonzero((rows >= s) & (rows <= n))
+    if not len(cols):
+        cols = np.array([int(np.clip(((w + e) / 2 - transform.c) // transform.a, 0, shape[1] - 1))])
+    if not len(rows):
+        rows = np.array([int(np.clip(((s + n) / 2 - transform.f) // transform.e, 0, shape[0] - 1))])
+    return slice(int(rows[0]), int(rows[-1]) + 1), slice(int(cols[0]), int(cols[-1]) + 1)
+
+
+# Validity mask of a band: neither NaN nor the nodata value
+def valid_mask(data, nodata):
+    valid = ~np.isnan(data)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= data != nodata
+    return valid
+
+
+# Decimation factor and (height, width) of a raster shown with at most max_size pixels on a side
+def decimated(shape, max_size):
+    factor = max(1, math.ceil(max(shape) / max_size))
+    return factor, (math.ceil(shape[0] / factor), math.ceil(shape[1] / factor))
+
+
+# Build the overviews of GeoTIFFs down to factor, once per file
+def build_overviews(paths, factor):
+    import rasterio
+    from rasterio.enums import Resampling
+
+    factors = [f for f in OVERVIEW_FACTORS if f <= factor]
+    if not factors:
+        return
+    for path in paths:
+        if os.path.exists(path + ".ovr"):
+            continue
+        # Built next to a link of the GeoTIFF under a name of its own and moved into place,
+        # so no thread or process sharing the cache opens a half-written .ovr
+        tmp = path + "." + str(os.getpid()) + "-" + uuid.uuid4().hex + ".tif"
+        try:
+            try:
+                os.link(path, tmp)
+            except OSError:
+                shutil.copyfile(path, tmp)
+            with rasterio.Env(TIFF_USE_OVR=True), rasterio.open(tmp, "r+") as dst:
+                dst.build_overviews(factors, Resampling.average)
+            os.replace(tmp + ".ovr", path + ".ovr")
+        finally:
+            for leftover in (tmp, tmp + ".ovr"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+
+# Read every openEO_YYYY-MM-DDZ.tif in input_folder once into a stack stored in folder;
+# bounds (w, s, e, n) crops every day to that part, dates keeps only those days, and
+# max_size decimates it to at most that many pixels on a side (e.g. DISPLAY_SIZE); band picks
+# the band of multi-band files
+def load_stack(input_folder, folder, bounds=None, dates=None, max_size=None, band=1):
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.windows import Window
+
+    files = tif_files(input_folder)
+    if dates is not None:
+        files = {date: path for date, path in files.items() if date in set(dates)}
+    dates = sorted(files)
+    if not dates:
+        raise ValueError("No openEO_YYYY-MM-DDZ.tif files in " + input_folder)
+
+    with rasterio.open(files[dates[0]]) as src:
+        transform, crs = src.transform, src.crs
+        rows, cols = window(transform, src.shape, bounds) if bounds is not None else (slice(0, src.height), slice(0, src.width))
+    part = Window(cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start)
+    transform = transform * transform.translation(cols.start, rows.start)
+    factor, (height, width) = decimated((part.height, part.width), max_size) if max_size else (1, (part.height, part.width))
+    if factor > 1:
+        build_overviews([files[date] for date in dates], factor)
+        transform = transform * transform.scale(part.width / width, part.height / height)
+    shape = (len(dates), height, width)
+
+    os.makedirs(folder, exist_ok=True)
+    data = np.lib.format.open_memmap(os.path.join(folder, "data.npy"), mode="w+", dtype="float32", shape=shape)
+    valid = np.lib.format.open_memmap(os.path.join(folder, "valid.npy"), mode="w+", dtype="bool", shape=shape)
+    for i, date in enumerate(dates):
+        with rasterio.open(files[date]) as src:
+            src.read(band, out=data[i], window=part, resampling=Resampling.average)
+            valid[i] = valid_mask(data[i], src.nodatavals[band - 1])
+    data.flush()
+    valid.flush()
+    del data, valid
+    return RasterStack(folder, dates, transform, crs)
+
+
+# Write a stack as one GeoTIFF with a band per day, described by its date, and invalid cells as NaN
+def write_geotiff(stack, path):
+    import rasterio
+
+    profile = {"driver": "GTiff", "dtype": "float32", "count": len(stack), "height": stack.shape[1], "width": stack.shape[2],
+               "transform": stack.transform, "crs": stack.crs, "nodata": np.nan, "compress": "deflate", "tiled": True}
+    with rasterio.open(path, "w", **profile) as dst:
+        for i, label in enumerate(stack.labels):
+            dst.write(np.where(stack.valid[i], stack.data[i], np.nan).astype("float32"), i + 1)
+            dst.set_band_description(i + 1, label)
+    return path
@@ -0,0 +1,208 @@
+# Time-indexed store for aggregated time series
+#
+# For every (bbox, cloud, reducer) key the store keeps the daily values that
+# were already downloaded and the date intervals they cover. A new request
+# only has to fetch the intervals that are missing; the result is merged into
+# the stored series, so widening or sliding a window costs only the new days.
+import datetime, hashlib, json, os, threading
+import numpy as np
+import pandas as pd
+
+DAY = datetime.timedelta(days=1)
+
+# Days this close to today may still be processed by the backend, so they are never marked as fetched
+SETTLING_DAYS = 3
+
+
+def as_date(value):
+    return pd.Timestamp(value).date()
+
+
+# Values of an aggregate_spatial JSON result ({"2019-05-01T00:00:00Z": [[v]]}, i.e.
+# date -> geometry -> band) as a date index and a (dates, geometries, bands) array,
+# with nulls and missing geometries or bands as NaN
+def parse_aggregate_json(path):
+    with open(path, "r") as f:
+        result = json.load(f)
+    index = pd.to_datetime(list(result.keys()), utc=True)
+    cells = list(result.values())
+    # Results with one value per geometry and band convert in one go, None becoming NaN
+    try:
+        values = np.array(cells, dtype="float64")
+    except (TypeError, ValueError):
+        values = None
+    if values is None or values.ndim != 3:
+        values = _ragged(cells)
+    order = np.argsort(index.values, kind="stable")
+    return index[order], values[order]
+
+
+# Cells with nulls in place of lists, or with fewer bands for some geometries
+def _ragged(cells):
+    rows = [[g if isinstance(g, list) else [g] for g in (c if isinstance(c, list) else [c])] for c in cells]
+    geometries = max([len(row) for row in rows] + [1])
+    bands = max([len(g) for row in rows for g in row] + [1])
+    values = np.full((len(rows), geometries, bands), np.nan)
+    for i, row in enumerate(rows):
+        for j, g in enumerate(row):
+            values[i, j, :len(g)] = [np.nan if v is None else v for v in g]
+    return values
+
+
+# Parsed result of an aggregate JSON file, kept next to it as a compressed .npz
+# that later reads load instead of parsing the JSON again
+def load_aggregate(path):
+    binary = os.path.splitext(path)[0] + ".npz"
+    if os.path.exists(binary) and os.path.getmtime(binary) >= os.path.getmtime(path):
+        with np.load(binary) as f:
+            return pd.to_datetime(f["dates"], utc=True), f["values"]
+    index, values = parse_aggregate_json(path)
+    tmp = binary + ".tmp.npz"
+    try:
+        np.savez_compressed(tmp, dates=index.tz_convert(None).values.astype("datetime64[ns]").astype("int64"), values=values)
+        os.replace(tmp, binary)
+    except OSError:
+        # Read-only folder: parse again next time
+        pass
+    return index, values
+
+
+# One geometry and band of an aggregate result as a Series
+def read_aggregate_json(path, band=0, geometry=0):
+    index, values = load_aggregate(path)
+    if geometry < values.shape[1] and band < values.shape[2]:
+        return pd.Series(values[:, geometry, band], index=index, dtype="float64")
+    return pd.Series(np.nan, index=index, dtype="float64")
+
+
+# Split an inclusive (start, end) interval at the first day of every month
+def monthly_chunks(start, end):
+    chunks = []
+    while start <= end:
+        next_month = (start.replace(day=28) + 4 * DAY).replace(day=1)
+        chunks.append((start, min(end, next_month - DAY)))
+        start = next_month
+    return chunks
+
+
+# Merge inclusive (start, end) date intervals that overlap or touch
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + DAY:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class SeriesStore:
+
+    def __init__(self, root="cache/series"):
+        self.root = root
+        self._series = {}
+        self._covered = {}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(bbox, cloud, reducer):
+        payload = json.dumps([[round(float(v), 6) for v in bbox], round(float(cloud), 6), reducer])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    # Date intervals in [start, end] (inclusive) that have not been fetched yet
+    def missing(self, key, start, end):
+        start, end = as_date(start), as_date(end)
+        with self._lock:
+            covered = self._load(key)[1]
+        gaps = []
+        cursor = start
+        for a, b in covered:
+            if b < cursor:
+                continue
+            if a > end:
+                break
+            if a > cursor:
+                gaps.append((cursor, a - DAY))
+            cursor = max(cursor, b + DAY)
+        if cursor <= end:
+            gaps.append((cursor, end))
+        return gaps
+
+    # Add the values fetched for [start, end]; they replace what was stored for those days
+    def merge(self, key, start, end, series):
+        start, end = as_date(start), as_date(end)
+        series = series[(series.index.date >= start) & (series.index.date <= end)]
+        with self._lock:
+            stored, covered = self._load(key)
+            stored = stored[(stored.index.date < start) | (stored.index.date > end)]
+            stored = pd.concat([stored, series]).sort_index()
+            settled = min(end, datetime.date.today() - SETTLING_DAYS * DAY)
+            if start <= settled:
+                covered = merge_intervals(covered + [(start, settled)])
+            self._series[key], self._covered[key] = stored, covered
+            self._save(key)
+
+    # Stored values for [start, end]; days without a value inside fetched intervals
+    # (e.g. at the edge of two separately fetched intervals) are interpolated,
+    # days that were not fetched yet stay empty
+    def get(self, key, start, end):
+        start, end = as_date(start), as_date(end)
+        with self._lock:
+            stored, covered = self._load(key)
+        series = stored[(stored.index.date >= start) & (stored.index.date <= end)]
+        if series.empty:
+            return series
+        filled = series.interpolate(limit_area="inside")
+        days = series.index.date
+        inside = np.zeros(len(series), dtype=bool)
+        for a, b in covered:
+            inside |= (days >= a) & (days <= b)
+        return filled.where(inside | series.notna())
+
+    def _path(self, key):
+        return os.path.join(self.root, key + ".npz")
+
+    def _load(self, key):
+        if key not in self._series:
+            series = pd.Series([], index=pd.DatetimeIndex([], tz="UTC"), dtype="float64")
+            covered = []
+            if os.path.exists(self._path(key)):
+                with np.load(self._path(key)) as f:
+                    index = pd.to_datetime(f["dates"], utc=True)
+                    series = pd.Series(f["values"], index=index, dtype="float64")
+                    covered = [(datetime.date.fromordinal(int(a)), datetime.date.fromordinal(int(b))) for a, b in f["covered"]]
+            self._series[key], self._covered[key] = series, covered
+        return self._series[key], self._covered[key]
+
+    def _save(self, key):
+        series, covered = self._series[key], self._covered[key]
+        covered = np.array([(a.toordinal(), b.toordinal()) for a, b in covered], dtype="int64").reshape(-1, 2)
+        tmp = self._path(key) + ".tmp.npz"
+        np.savez(tmp, dates=series.index.tz_convert(None).values.astype("datetime64[ns]").astype("int64"),
+                 values=series.values, covered=covered)
+        os.replace(tmp, self._path(key))
+
+
+# Downloads of one request, as futures of the job manager, counting the
+# chunks that landed so a plot can be redrawn as they arrive. A cancelled
+# chunk (e.g. when the user submits again) counts as landed.
+class SeriesFetch:
+
+    def __init__(self, futures):
+        self.futures = list(futures)
+        self.total = len(self.futures)
+        self.completed = 0
+        self.errors = []
+        self._lock = threading.Lock()
+        for future in self.futures:
+            future.add_done_callback(self._landed)
+
+    def _landed(self, future):
+        with self._lock:
+            if not future.cancelled() and future.exception() is not None:
+                self.errors.append(future.exception())
+            self.completed += 1
+
+    def done(self):
+        return self.completed >= self.total
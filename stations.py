@@ -0,0 +1,73 @@
+# Local NO2 station measurements for South Tyrol
+#
+# The spreadsheet is converted once into a compact .npz file (day numbers,
+# per-station values and their mean) and kept in memory for every session.
+# It is converted again only when the spreadsheet changes, and date filtering
+# is a binary search on the sorted day index.
+import os, threading
+import numpy as np
+import pandas as pd
+
+# Area covered by the stations, and the first day of SENTINEL 5P data to compare them with
+BBOX = (10.35, 46.10, 12.55, 47.13)
+FIRST_DATE = pd.Timestamp("2018-12-14")
+
+# The spreadsheet is in µg/m³, scaled to the order of magnitude of the satellite values
+SCALE = 10e-2
+
+
+class StationData:
+
+    def __init__(self, path="data/rshiny_NO2_TM75_2017-2022.xlsx", cache_path=None):
+        self.path = path
+        self.cache_path = cache_path or os.path.splitext(path)[0] + ".npz"
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    # Convert the spreadsheet if the .npz is missing or older, then keep the arrays in memory
+    def refresh(self):
+        mtime = os.path.getmtime(self.path)
+        with self._lock:
+            if self._mtime == mtime:
+                return
+            if not os.path.exists(self.cache_path) or os.path.getmtime(self.cache_path) < mtime:
+                self._convert()
+            with np.load(self.cache_path) as f:
+                self.days = f["days"]
+                self.values = f["values"]
+                self.stations = list(f["stations"])
+                self.mean = f["mean"]
+            self._mtime = mtime
+
+    def _convert(self):
+        df = pd.read_excel(self.path)
+
+        # Four header rows (Messwert, MW-Typ, Einheit, empty) follow the station names
+        df = df.iloc[4:]
+        days = pd.to_datetime(df.iloc[:, 0]).values.astype("datetime64[D]").astype("int64")
+        values = df.iloc[:, 1:].apply(pd.to_numeric, errors="coerce").to_numpy(dtype="float32")
+        order = np.argsort(days, kind="stable")
+        tmp = self.cache_path + ".tmp.npz"
+        np.savez(tmp, days=days[order], values=values[order], stations=np.array(df.columns[1:], dtype=str),
+                 mean=np.nanmean(values[order], axis=1) * SCALE)
+        os.replace(tmp, self.cache_path)
+
+    @property
+    def last_date(self):
+        self.refresh()
+        return pd.Timestamp(np.datetime64(int(self.days[-1]), "D"))
+
+    def covers(self, bbox, start, end):
+        w, s, e, n = bbox
+        return (e <= BBOX[2] and w >= BBOX[0] and s >= BBOX[1] and n <= BBOX[3]
+                and pd.Timestamp(start) >= FIRST_DATE and pd.Timestamp(end) <= self.last_date)
+
+    # Mean over the stations between start and end (inclusive), indexed like the openEO series
+    def series(self, start, end):
+        self.refresh()
+        first = pd.Timestamp(start).to_datetime64().astype("datetime64[D]").astype("int64")
+        last = pd.Timestamp(end).to_datetime64().astype("datetime64[D]").astype("int64")
+        i = np.searchsorted(self.days, first, side="left")
+        j = np.searchsorted(self.days, last, side="right")
+        index = pd.to_datetime(self.days[i:j].astype("datetime64[D]")).tz_localize("UTC")
+        return pd.Series(self.mean[i:j], index=index, name="Local")
@@ -0,0 +1,4 @@
+# The app's modules live at the top of the repository
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,46 @@
+import datetime
+import numpy as np
+from clouds import RawBands, interpolate_linear
+from raster import RasterStack
+
+
+def test_interpolate_linear_fills_inner_gaps_only():
+    data = np.array([np.nan, 1.0, np.nan, np.nan, 4.0, np.nan])
+    np.testing.assert_allclose(interpolate_linear(data), [np.nan, 1.0, 2.0, 3.0, 4.0, np.nan])
+
+
+def test_interpolate_linear_works_per_cell_along_time():
+    data = np.array([[1.0, np.nan], [np.nan, 5.0], [3.0, np.nan]])
+    np.testing.assert_allclose(interpolate_linear(data), [[1.0, np.nan], [2.0, 5.0], [3.0, np.nan]])
+
+
+def test_interpolate_linear_keeps_an_all_empty_series():
+    assert np.isnan(interpolate_linear(np.full((4, 2), np.nan))).all()
+
+
+def stack(folder, data):
+    folder.mkdir()
+    np.save(folder / "data.npy", data.astype("float32"))
+    np.save(folder / "valid.npy", ~np.isnan(data))
+    dates = [datetime.date(2019, 7, 1) + datetime.timedelta(days=i) for i in range(len(data))]
+    return RasterStack(str(folder), dates)
+
+
+def test_a_frame_matches_the_masked_stack(tmp_path):
+    rng = np.random.default_rng(0)
+    no2 = rng.random((12, 3, 4))
+    no2[rng.random(no2.shape) < 0.2] = np.nan
+    bands = RawBands(stack(tmp_path / "no2", no2), stack(tmp_path / "cloud", rng.random(no2.shape)))
+    masked = bands.masked(0.5, str(tmp_path / "masked"))
+    for index in range(len(bands)):
+        frame = bands.frame(index, 0.5)
+        np.testing.assert_array_equal(frame.mask, ~masked.valid[index])
+        np.testing.assert_allclose(frame.filled(np.nan), np.where(masked.valid[index], masked.data[index], np.nan), rtol=1e-6)
+
+
+def test_cloudy_cells_are_filled_from_clear_days(tmp_path):
+    no2 = np.array([1.0, 9.0, 3.0]).reshape(3, 1, 1)
+    cloud = np.array([0.1, 0.9, 0.1]).reshape(3, 1, 1)
+    bands = RawBands(stack(tmp_path / "no2", no2), stack(tmp_path / "cloud", cloud))
+    assert bands.frame(1, 0.5)[0, 0] == 2.0
+    assert bands.frame(1, 0.95)[0, 0] == 9.0
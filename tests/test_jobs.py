@@ -0,0 +1,100 @@
+import threading, time
+from concurrent.futures import Future, ThreadPoolExecutor
+import pytest
+from jobs import JobCancelled, JobManager
+
+
+# Lets the blocking jobs of a test end, even when it fails
+@pytest.fixture
+def finish():
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+@pytest.fixture
+def jobs():
+    executor = ThreadPoolExecutor(max_workers=4)
+    yield JobManager(executor, batch_workers=2, max_queued=4, per_session=2)
+    executor.shutdown(wait=False)
+
+
+# A job that runs until it is released or finished, stopping like run_batch_job once cancelled
+def blocking(calls, finish):
+    def fn(cancelled):
+        calls.append(cancelled)
+        while not finish.wait(0.01):
+            if cancelled.is_set():
+                raise JobCancelled()
+        return "done"
+    return fn
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_identical_submits_share_one_run(jobs, finish):
+    calls = []
+    first = jobs.submit("key", blocking(calls, finish), "a")
+    second = jobs.submit("key", blocking(calls, finish), "b")
+    finish.set()
+    assert first.result(5) == second.result(5) == "done"
+    assert len(calls) == 1
+    assert jobs.stats()["coalesced"] == 1
+
+
+def test_release_cancels_a_job_nobody_waits_for(jobs, finish):
+    calls = []
+    waiter = jobs.submit("key", blocking(calls, finish), "a", "tab", batch=True)
+    wait_for(lambda: calls)
+    jobs.release("a", "tab")
+    assert waiter.cancelled()
+    assert calls[0].wait(5)
+    assert jobs.stats()["cancelled"] == 1
+
+
+def test_release_keeps_a_job_another_session_waits_for(jobs, finish):
+    calls = []
+    jobs.submit("key", blocking(calls, finish), "a")
+    other = jobs.submit("key", blocking(calls, finish), "b")
+    wait_for(lambda: calls)
+    jobs.release("a")
+    assert not calls[0].is_set()
+    finish.set()
+    assert other.result(5) == "done"
+
+
+# Submit clicked twice: the second submit must not join the job the first release is stopping
+def test_resubmit_joins_the_job_before_the_release(jobs, finish):
+    calls = []
+    jobs.submit("key", blocking(calls, finish), "a", "map-maker-1", batch=True)
+    wait_for(lambda: calls)
+    again = jobs.submit("key", blocking(calls, finish), "a", "map-maker-2", batch=True)
+    jobs.release("a", "map-maker-1")
+    finish.set()
+    assert again.result(5) == "done"
+    assert len(calls) == 1
+    assert jobs.stats()["started"] == 1
+    assert jobs.stats()["cancelled"] == 0
+
+
+def test_then_runs_on_the_result(jobs):
+    future = Future()
+    chained = jobs.then(future, lambda value: value * 2)
+    future.set_result(21)
+    assert chained.result(5) == 42
+
+
+def test_then_passes_errors_and_cancellations_on(jobs):
+    failed, cancelled = Future(), Future()
+    failed_then = jobs.then(failed, lambda value: value)
+    cancelled_then = jobs.then(cancelled, lambda value: value)
+    failed.set_exception(ValueError("backend"))
+    cancelled.cancel()
+    with pytest.raises(ValueError):
+        failed_then.result(5)
+    assert cancelled_then.cancelled()
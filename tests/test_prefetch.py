@@ -0,0 +1,27 @@
+from prefetch import Prefetcher
+
+REGIONS = [{"name": "South Tyrol", "bbox": (11.0, 46.1, 12.2, 47.1), "days": 31, "cloud": 0.5, "maps": True}]
+
+
+def stopped_prefetcher():
+    prefetcher = Prefetcher(None, None, None, None, None, REGIONS, interval=0)
+    # Nothing is fetched, start() only decides whether this process prefetches
+    prefetcher.stop()
+    return prefetcher
+
+
+def test_only_the_holder_of_the_lock_prefetches(tmp_path):
+    lock = str(tmp_path / "prefetch.lock")
+    first, second = stopped_prefetcher(), stopped_prefetcher()
+    first.start(lock=lock)
+    second.start(lock=lock)
+    assert first.active and not second.active
+    assert second.status()["active"] is False
+    assert second.stale() == 0
+
+
+def test_without_a_lock_every_prefetcher_runs():
+    prefetcher = stopped_prefetcher()
+    prefetcher.start()
+    assert prefetcher.active
+    assert prefetcher.stale() == 1
@@ -0,0 +1,87 @@
+import datetime, json
+import numpy as np
+import pandas as pd
+from series import SETTLING_DAYS, SeriesStore, monthly_chunks, parse_aggregate_json
+
+D = datetime.date
+
+
+def daily(start, end, value=1.0):
+    index = pd.date_range(str(start), str(end), freq="D", tz="UTC")
+    return pd.Series(value, index=index, dtype="float64")
+
+
+def test_missing_days_of_an_empty_store(tmp_path):
+    store = SeriesStore(str(tmp_path))
+    key = store.key((11.0, 46.1, 12.2, 47.1), 0.5, "mean")
+    assert store.missing(key, D(2019, 5, 1), D(2019, 8, 31)) == [(D(2019, 5, 1), D(2019, 8, 31))]
+
+
+def test_merge_leaves_only_the_gaps_missing(tmp_path):
+    store = SeriesStore(str(tmp_path))
+    key = store.key((11.0, 46.1, 12.2, 47.1), 0.5, "mean")
+    store.merge(key, D(2019, 6, 1), D(2019, 6, 30), daily(D(2019, 6, 1), D(2019, 6, 30)))
+    assert store.missing(key, D(2019, 5, 1), D(2019, 8, 31)) == [(D(2019, 5, 1), D(2019, 5, 31)), (D(2019, 7, 1), D(2019, 8, 31))]
+    assert store.missing(key, D(2019, 6, 5), D(2019, 6, 20)) == []
+
+
+def test_merged_series_survive_a_new_store(tmp_path):
+    store = SeriesStore(str(tmp_path))
+    key = store.key((11.0, 46.1, 12.2, 47.1), 0.5, "max")
+    store.merge(key, D(2019, 6, 1), D(2019, 6, 10), daily(D(2019, 6, 1), D(2019, 6, 10), 2.0))
+    reopened = SeriesStore(str(tmp_path))
+    assert reopened.missing(key, D(2019, 6, 1), D(2019, 6, 10)) == []
+    assert (reopened.get(key, D(2019, 6, 1), D(2019, 6, 10)) == 2.0).all()
+
+
+def test_recent_days_stay_missing(tmp_path):
+    store = SeriesStore(str(tmp_path))
+    key = store.key((11.0, 46.1, 12.2, 47.1), 0.5, "mean")
+    today = datetime.date.today()
+    start = today - datetime.timedelta(days=10)
+    store.merge(key, start, today, daily(start, today))
+    settled = today - datetime.timedelta(days=SETTLING_DAYS)
+    assert store.missing(key, start, today) == [(settled + datetime.timedelta(days=1), today)]
+
+
+def test_get_interpolates_inside_fetched_days_only(tmp_path):
+    store = SeriesStore(str(tmp_path))
+    key = store.key((11.0, 46.1, 12.2, 47.1), 0.5, "mean")
+    values = daily(D(2019, 6, 1), D(2019, 6, 3))
+    values.iloc[1] = np.nan
+    values.iloc[2] = 3.0
+    store.merge(key, D(2019, 6, 1), D(2019, 6, 3), values)
+    assert store.get(key, D(2019, 6, 1), D(2019, 6, 3)).tolist() == [1.0, 2.0, 3.0]
+
+
+def test_monthly_chunks():
+    assert monthly_chunks(D(2019, 5, 15), D(2019, 7, 3)) == [
+        (D(2019, 5, 15), D(2019, 5, 31)), (D(2019, 6, 1), D(2019, 6, 30)), (D(2019, 7, 1), D(2019, 7, 3))]
+
+
+def aggregate(tmp_path, result):
+    path = tmp_path / "timeseries.json"
+    path.write_text(json.dumps(result))
+    return str(path)
+
+
+def test_parse_aggregate_json_sorts_dates_and_reads_nulls_as_nan(tmp_path):
+    index, values = parse_aggregate_json(aggregate(tmp_path, {
+        "2019-05-02T00:00:00Z": [[None]], "2019-05-01T00:00:00Z": [[1.5]]}))
+    assert [str(d.date()) for d in index] == ["2019-05-01", "2019-05-02"]
+    assert values.shape == (2, 1, 1)
+    assert values[0, 0, 0] == 1.5 and np.isnan(values[1, 0, 0])
+
+
+def test_parse_aggregate_json_pads_ragged_results(tmp_path):
+    index, values = parse_aggregate_json(aggregate(tmp_path, {
+        "2019-05-01T00:00:00Z": [[1.0, 2.0], [3.0]], "2019-05-02T00:00:00Z": None, "2019-05-03T00:00:00Z": [4.0]}))
+    assert values.shape == (3, 2, 2)
+    np.testing.assert_array_equal(values[0], [[1.0, 2.0], [3.0, np.nan]])
+    assert np.isnan(values[1]).all()
+    np.testing.assert_array_equal(values[2], [[4.0, np.nan], [np.nan, np.nan]])
+
+
+def test_parse_aggregate_json_keeps_every_geometry(tmp_path):
+    index, values = parse_aggregate_json(aggregate(tmp_path, {"2019-05-01T00:00:00Z": [[1.0, 2.0], [3.0, 4.0]]}))
+    np.testing.assert_array_equal(values[0], [[1.0, 2.0], [3.0, 4.0]])
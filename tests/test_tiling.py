@@ -0,0 +1,53 @@
+import threading, time
+import numpy as np
+import pandas as pd
+import tiling
+
+
+def test_combine_mean_weights_tiles_by_their_valid_pixels():
+    index = pd.date_range("2019-06-01", periods=3, tz="UTC")
+    means = [pd.Series([1.0, 1.0, np.nan], index=index), pd.Series([4.0, np.nan, 2.0], index=index)]
+    counts = [pd.Series([2.0, 5.0, 3.0], index=index), pd.Series([1.0, 5.0, 0.0], index=index)]
+    combined = tiling.combine_mean(means, counts)
+    assert combined.iloc[0] == 2.0
+    # A tile without a value that day is left out
+    assert combined.iloc[1] == 1.0
+    # Neither tile has a weighted value
+    assert np.isnan(combined.iloc[2])
+
+
+def test_combine_max():
+    index = pd.date_range("2019-06-01", periods=2, tz="UTC")
+    combined = tiling.combine_max([pd.Series([1.0, np.nan], index=index), pd.Series([3.0, 2.0], index=index)])
+    assert combined.tolist() == [3.0, 2.0]
+
+
+def test_split_covers_the_bbox_with_equal_tiles():
+    tiles = tiling.split((11.0, 46.0, 15.0, 47.0), max_size=2.0)
+    assert tiles == [(11.0, 46.0, 13.0, 47.0), (13.0, 46.0, 15.0, 47.0)]
+    assert tiling.split((11.0, 46.1, 12.2, 47.1), max_size=2.0) == [(11.0, 46.1, 12.2, 47.1)]
+
+
+def test_aggregate_of_one_tile_fetches_it_directly():
+    calls = []
+    tiling.aggregate(lambda tile, name: calls.append((tile, name)), (11.0, 46.1, 12.2, 47.1), "mean", 2.0)
+    assert calls == [((11.0, 46.1, 12.2, 47.1), "mean")]
+
+
+def test_tile_batch_jobs_are_capped():
+    lock = threading.Lock()
+    running, peak = [0], [0]
+
+    class Results:
+        def job_folder(self, datacube, stage=None, cancelled=None):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return datacube
+
+    results = Results()
+    assert tiling.map_tiles(lambda tile: tiling.batch_job_folder(results, tile), list(range(8))) == list(range(8))
+    assert peak[0] == tiling.BATCH_JOBS
@@ -0,0 +1,144 @@
+# Spatial tiling of large requests
+#
+# A bbox larger than MAX_TILE degrees on a side is split into a grid of equal
+# tiles, and every tile is requested from the backend on its own, side by side
+# on a pool of threads. Daily GeoTIFFs of the tiles are merged back into one
+# mosaic per day; time-series aggregates are combined exactly: the maximum is
+# the maximum of the tiles, the mean is the mean of the tiles weighted by
+# their number of valid pixels on that day (the "count" reducer).
+#
+# S5P_TILE_DEGREES sets the largest tile side in degrees. At most S5P_BATCH_JOBS
+# batch jobs (2 by default, as many as the job manager runs) are run on the
+# backend at once, whatever the number of tiles.
+import math, os, threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from jobs import JobCancelled
+
+MAX_TILE = float(os.environ.get("S5P_TILE_DEGREES", "2.0"))
+BATCH_JOBS = int(os.environ.get("S5P_BATCH_JOBS", "2"))
+
+_batch_slots = threading.BoundedSemaphore(BATCH_JOBS)
+
+_pool = None
+
+
+# Shared pool for tile requests, started on first use; callers waiting on it
+# run on other executors, so a full pool never waits on itself
+def pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tile")
+    return _pool
+
+
+# Grid of (w, s, e, n) tiles covering bbox, none larger than max_size degrees on a side
+def split(bbox, max_size=None):
+    max_size = max_size or MAX_TILE
+    w, s, e, n = bbox
+    nx = max(1, math.ceil(round((e - w) / max_size, 9)))
+    ny = max(1, math.ceil(round((n - s) / max_size, 9)))
+    xs = np.linspace(w, e, nx + 1)
+    ys = np.linspace(s, n, ny + 1)
+    return [(float(xs[i]), float(ys[j]), float(xs[i + 1]), float(ys[j + 1])) for j in range(ny) for i in range(nx)]
+
+
+# GeoJSON polygon of a bbox, as the app sends it to openEO
+def extent(bbox):
+    w, s, e, n = bbox
+    return {"type": "Polygon", "coordinates": [[[w, n], [e, n], [e, s], [w, s], [w, n]]]}
+
+
+# results.job_folder of a datacube once one of the BATCH_JOBS slots is free;
+# a job cancelled while it waits for a slot is never started
+def batch_job_folder(results, datacube, stage=None, cancelled=None):
+    while not _batch_slots.acquire(timeout=1):
+        if cancelled is not None and cancelled.is_set():
+            raise JobCancelled()
+    try:
+        return results.job_folder(datacube, stage, cancelled)
+    finally:
+        _batch_slots.release()
+
+
+# fn(tile) for every tile on the pool, results in the order of the tiles
+def map_tiles(fn, tiles):
+    futures = [pool().submit(fn, tile) for tile in tiles]
+    return [future.result() for future in futures]
+
+
+# Weighted mean of aligned series; days where a tile has no value or no weight leave it out
+def combine_mean(means, counts):
+    import pandas as pd
+
+    means = pd.concat(means, axis=1)
+    counts = pd.concat(counts, axis=1).reindex(means.index)
+    counts.columns = means.columns
+    weights = counts.where(means.notna() & (counts > 0), 0).fillna(0)
+    total = weights.sum(axis=1)
+    return ((means.fillna(0) * weights).sum(axis=1) / total).where(total > 0)
+
+
+def combine_max(maxes):
+    import pandas as pd
+
+    return pd.concat(maxes, axis=1).max(axis=1)
+
+
+# Series of bbox for a reducer ("mean" or "max"), from fetch(tile, reducer) -> Series of every tile
+def aggregate(fetch, bbox, reducer, max_size=None):
+    tiles = split(bbox, max_size)
+    if len(tiles) == 1:
+        return fetch(tiles[0], reducer)
+    if reducer == "max":
+        return combine_max(map_tiles(lambda tile: fetch(tile, "max"), tiles))
+    if reducer != "mean":
+        raise ValueError("Only mean and max can be combined over tiles, not " + reducer)
+    parts = map_tiles(lambda task: fetch(*task), [(tile, name) for name in ("mean", "count") for tile in tiles])
+    return combine_mean(parts[:len(tiles)], parts[len(tiles):])
+
+
+# Merge GeoTIFFs of neighbouring tiles into one file
+def mosaic(paths, target):
+    import rasterio
+    from rasterio.merge import merge
+
+    sources = [rasterio.open(path) for path in paths]
+    try:
+        profile = sources[0].profile
+        nodata = profile.get("nodata")
+        if nodata is None and np.dtype(profile["dtype"]).kind == "f":
+            nodata = np.nan
+        data, transform = merge(sources, nodata=nodata)
+    finally:
+        for src in sources:
+            src.close()
+    profile.update(height=data.shape[1], width=data.shape[2], count=data.shape[0], transform=transform, nodata=nodata)
+    profile.pop("blockxsize", None)
+    profile.pop("blockysize", None)
+    with rasterio.open(target, "w", **profile) as dst:
+        dst.write(data)
+    return target
+
+
+# Folder of the batch job results of bbox, cube(tile) building the datacube of a
+# tile; with several tiles, their jobs run side by side and the cached folder
+# holds one mosaic per day
+def job_folder(results, cube, bbox, stage=None, cancelled=None, max_size=None):
+    from raster import TIF_REGEX
+
+    tiles = split(bbox, max_size)
+    if len(tiles) == 1:
+        return batch_job_folder(results, cube(tiles[0]), stage, cancelled)
+
+    def produce(tmp):
+        days = {}
+        folders = map_tiles(lambda tile: batch_job_folder(results, cube(tile), stage, cancelled), tiles)
+        for folder in folders:
+            for filename in os.listdir(folder):
+                if TIF_REGEX.match(filename):
+                    days.setdefault(filename, []).append(os.path.join(folder, filename))
+        for filename, paths in days.items():
+            mosaic(paths, os.path.join(tmp, filename))
+
+    return results.fetch(results.key(cube(bbox), batch=True, tiles=len(tiles)), produce)
@@ -0,0 +1,114 @@
+# Streaming encoders for the Spacetime Animation
+#
+# Frames are written to the output file as soon as they are rendered, so the
+# memory used while encoding does not grow with the number of days. MP4 and
+# WebM go through ffmpeg (the optional imageio-ffmpeg package); GIF is always
+# available and written frame by frame with one fixed palette, storing only
+# the part of a frame that changed since the previous one (the map and the
+# date in the title).
+import struct
+import numpy as np
+
+# format -> (MIME type, imageio ffmpeg writer options)
+FORMATS = {
+    "mp4": ("video/mp4", {"codec": "libx264", "quality": 7, "pixelformat": "yuv420p", "macro_block_size": 2,
+                          "ffmpeg_params": ["-preset", "veryfast", "-movflags", "+faststart"]}),
+    "webm": ("video/webm", {"codec": "libvpx-vp9", "pixelformat": "yuv420p", "macro_block_size": 2,
+                            "ffmpeg_params": ["-crf", "32", "-b:v", "0", "-deadline", "realtime", "-cpu-used", "8"]}),
+    "gif": ("image/gif", None),
+}
+
+
+def ffmpeg_available():
+    try:
+        import imageio_ffmpeg
+        imageio_ffmpeg.get_ffmpeg_exe()
+        return True
+    except Exception:
+        return False
+
+
+# Formats that can be written here, video ones first
+def formats():
+    return [fmt for fmt, (_, options) in FORMATS.items() if options is None or ffmpeg_available()]
+
+
+def mime_type(fmt):
+    return FORMATS[fmt][0]
+
+
+# Writer with append_data(frame) and close(), for RGB frames of equal size;
+# colors are the ones a GIF palette should keep exactly (e.g. the colormap)
+def open_writer(path, fmt, fps, colors=None):
+    options = FORMATS[fmt][1]
+    if options is None:
+        return GifWriter(path, fps, palette(colors))
+    import imageio
+    return imageio.get_writer(path, format="FFMPEG", mode="I", fps=fps, **options)
+
+
+# 256 colors: 32 greys for text, axes and the white background, and the rest
+# spread evenly over the given colors
+def palette(colors=None, greys=32):
+    if colors is None:
+        from matplotlib import colormaps
+        colors = colormaps["viridis"](np.linspace(0, 1, 256))[:, :3] * 255
+    colors = np.asarray(colors, dtype="float64")
+    picks = colors[np.linspace(0, len(colors) - 1, 256 - greys).round().astype(int)]
+    grey = np.repeat(np.linspace(0, 255, greys)[:, None], 3, axis=1)
+    return np.concatenate([grey, picks]).round().clip(0, 255).astype(np.uint8)
+
+
+class GifWriter:
+
+    def __init__(self, path, fps, palette):
+        from PIL import Image
+
+        self.file = open(path, "wb")
+        # GIF delays are in hundredths of a second, and browsers slow down anything below 2
+        self.delay = max(int(round(100 / fps)), 2)
+        self.palette = Image.new("P", (1, 1))
+        self.palette.putpalette(palette.tobytes())
+        self.previous = None
+
+    def append_data(self, frame):
+        from PIL import Image, GifImagePlugin
+
+        indexed = Image.fromarray(np.ascontiguousarray(frame[..., :3])).quantize(palette=self.palette, dither=0)
+        pixels = np.asarray(indexed)
+        if self.previous is None:
+            self._header(indexed.size)
+            box = (0, 0, pixels.shape[1], pixels.shape[0])
+        else:
+            box = self._changed(pixels)
+        self.previous = pixels
+
+        # Disposal 1 keeps the previous frame under the part that is drawn now
+        part = indexed.crop(box)
+        for chunk in GifImagePlugin.getdata(part, offset=box[:2], duration=self.delay * 10, disposal=1):
+            self.file.write(chunk)
+
+    # Smallest box holding every pixel that differs from the previous frame
+    def _changed(self, pixels):
+        changed = pixels != self.previous
+        rows, cols = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+        if not len(rows):
+            return (0, 0, 1, 1)
+        return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+    def _header(self, size):
+        self.file.write(b"GIF89a" + struct.pack("<HHBBB", size[0], size[1], 0xF7, 0, 0))
+        self.file.write(bytes(self.palette.getpalette()[:768]).ljust(768, b"\0"))
+        # Loop forever
+        self.file.write(b"!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")
+
+    def close(self):
+        if self.previous is not None:
+            self.file.write(b";")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
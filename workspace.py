@@ -0,0 +1,58 @@
+# Per-session scratch space
+#
+# Every Shiny session gets its own temporary folder for downloads, frames and
+# animations, so concurrent users of one worker never read or delete each
+# other's files. The folder is removed when the session ends.
+import atexit, os, shutil, tempfile, threading
+
+
+class Workspace:
+
+    def __init__(self, root, prefix="session-"):
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=root)
+
+    # Folder inside the workspace
+    def folder(self, *parts):
+        path = os.path.join(self.path, *parts)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    # Removes a folder of the workspace with what is in it
+    def remove(self, *parts):
+        shutil.rmtree(os.path.join(self.path, *parts), ignore_errors=True)
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class WorkspaceManager:
+
+    def __init__(self, root=None):
+        # One folder per worker process, so workers sharing a node stay apart as well
+        self.root = tempfile.mkdtemp(prefix="s5p-dashboard-", dir=root)
+        self._open = {}
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    # Workspace for a Shiny session, removed again when the session ends
+    def open(self, session=None):
+        workspace = Workspace(self.root)
+        with self._lock:
+            self._open[workspace.path] = workspace
+        if session is not None:
+            session.on_ended(lambda: self.release(workspace))
+        return workspace
+
+    def release(self, workspace):
+        with self._lock:
+            self._open.pop(workspace.path, None)
+        workspace.cleanup()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._open)
+
+    def close(self):
+        with self._lock:
+            self._open.clear()
+        shutil.rmtree(self.root, ignore_errors=True)